@@ -14,28 +14,69 @@ from OpenGL.GLUT import *
 from lib import objloader
 from lib.epoc import Epoc
 from lib.sourcelocalizer import SourceLocalizer
+from lib.filters import StreamingFilter
+from lib.forward import SourceGrid, SphericalHead
+from lib.beamformer import Beamformer
+from lib.inverse import InverseOperator
+from lib.latency import LatencyTracer
+from lib.ringbuffer import clock
 from OpenGL.GL.shaders import *
 from threading import Thread
 from multiprocessing import freeze_support
 from cgkit.cgtypes import vec3, mat4
+import numpy as np
 import traceback
 import time
 import math
-from lib.emokit import emotiv
-import gevent
 import sys
 import warnings
 import copy
 
 warnings.filterwarnings("ignore", category=DeprecationWarning) 
 
+# Startup timing, measured from module import
+startup_origin = time.time()
+first_frame = False
+
 # Global variables
 brain = None
+model_loader = None
 program = None
 epoc = None
 sample_sec = 2.0
+hop_sec = 0.25
+record_path = None
+replay_path = None
+replay_speed = 1.0
 localizer = None
+# Preprocessing ahead of ICA, band in Hz or None, mains frequency or None
+stream_filter = None
+filter_band = (1.0, 40.0)
+filter_notch = 50.0
+# 'fastica' decomposes every window, 'online' updates with the new samples only
+ica_engine = 'fastica'
+# 'least-squares', 'nelder-mead' or 'grid' fit of the source positions
+localizer_solver = 'least-squares'
+# 'heuristic' contributions or 'sphere' for the multi-shell spherical head, used by the fit and the activity
+forward_model = 'heuristic'
 source_locations = []
+# Persistent component id of every source, keeps colors and labels with the source
+source_ids = []
+# Whole-brain activity, (voxel positions, relative power) of the strongest voxels
+show_activity = False
+# 'beamformer', or the distributed inverse 'sloreta' or 'mne'
+activity_engine = 'beamformer'
+activity_scanner = None
+activity_grid = None
+activity = None
+activity_share = 0.05
+# (region, share of the activity, peak) of the regions, strongest first
+activity_regions = []
+# Latency of every pipeline stage, latency_path receives the histograms on exit
+latency = LatencyTracer()
+latency_path = None
+# (read time, publish time) of sources not yet shown on screen
+pending_trace = None
 localizer_thread_alive = True
 influential_per_source = 3
 most_influential_electrodes = dict()
@@ -111,19 +152,7 @@ def initgl():
     glEnable(GL_BLEND)
     glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
     
-    # Initialize model
-    init_model()
-
-    # Initialize functions
-    glutReshapeFunc(reshape)
-    glutDisplayFunc(display)
-    glutIdleFunc(idle)
-    glutMouseFunc(mouse)
-    glutMotionFunc(mouse_drag)
-    glutKeyboardFunc(keyboard)
-    glutSpecialFunc(keyboard)
-    
-    # Set up shaders
+    # Set up shaders while the model is still being parsed
     with open("brain_vertex_shader.glsl") as vertex_shader, open("brain_fragment_shader.glsl") as fragment_shader:    
         program = compileProgram(
             compileShader(vertex_shader.read(), GL_VERTEX_SHADER),
@@ -135,6 +164,16 @@ def initgl():
     p_shader_mode = glGetUniformLocation(program, 'shader_mode')
     if p_shader_mode in (None,-1):
         print 'Warning, no uniform: %s'%( 'shader_mode' )
+    startup_step('Window and shaders')
+
+    # Initialize functions
+    glutReshapeFunc(reshape)
+    glutDisplayFunc(display)
+    glutIdleFunc(idle)
+    glutMouseFunc(mouse)
+    glutMotionFunc(mouse_drag)
+    glutKeyboardFunc(keyboard)
+    glutSpecialFunc(keyboard)
 
     # Start main loop
     glutMainLoop()
@@ -149,6 +188,8 @@ def createMenu():
     glutAddMenuEntry("Change transparency mode - T", 1)
     glutAddMenuEntry('Change pause mode - P', 2)
     glutAddMenuEntry("Initial view - I", 3)
+    glutAddMenuEntry("Latency report - L", 5)
+    glutAddMenuEntry("Activity volume - A", 6)
     glutAddSubMenu("Display:", menu)
     glutAddMenuEntry("Quit - ESC", 4)
     
@@ -186,14 +227,47 @@ def processMainMenu(option):
         glLoadIdentity()
     elif option == 4:
         quit()
+    elif option == 5:
+        print_latency()
+    elif option == 6:
+        toggle_activity()
+
+def print_latency():
+    print latency.summary()
+    if localizer is not None and localizer.mixing_matrix is not None:
+        print 'Last ICA: %d iterations in %.1f ms, %s start, %d cold starts' % (
+            localizer.ica_iterations, 1000 * localizer.ica_time,
+            'warm' if localizer.ica_warm else 'cold', localizer.ica_cold_starts)
+
+def startup_step(name):
+    print 'Startup: %s ready after %.2f s' % (name, time.time() - startup_origin)
 
 def initepoc():
+    '''
+    Start the reader process, the device is found by epoc.wait_device
+    '''
     global epoc
-    epoc = Epoc(sample_sec)
+    epoc = Epoc(sample_sec, hop_sec, record_path, replay_path, replay_speed, wait_device=False)
+
+def initpipeline():
+    '''
+    Find the device and start localizing, runs next to window and model setup
+    '''
+    # Reader is forked before the warm-up imports, which hold the import lock fork waits on
+    initepoc()
+    warmup = Thread(target=SourceLocalizer(None).warm_up, args=(int(128 * sample_sec), len(Epoc.coordinates)))
+    warmup.start()
+    epoc.wait_device()
+    startup_step('Device')
+    warmup.join()
+    startup_step('ICA')
+    initsourceloc()
 
 def initsourceloc():
     global localizer
-    localizer = SourceLocalizer(epoc)
+    global stream_filter
+    stream_filter = StreamingFilter(len(Epoc.coordinates), epoc.sample_size, 128.0, filter_band, filter_notch)
+    localizer = SourceLocalizer(epoc, ica_engine, localizer_solver, forward=forward_model)
     source_localizer_thread = Thread(target=localize_sources)
     source_localizer_thread.start()
 
@@ -255,6 +329,21 @@ def display():
     # Switch buffers
     glutSwapBuffers()
 
+    # Close the trace of the sources this frame shows for the first time
+    global pending_trace
+    trace = pending_trace
+    if trace is not None:
+        pending_trace = None
+        swapped = clock()
+        latency.record('handoff', swapped - trace[1])
+        latency.record('end_to_end', swapped - trace[0])
+
+    # First frame that shows the model
+    global first_frame
+    if not first_frame and scene_id == 1 and brain is not None:
+        first_frame = True
+        startup_step('First frame')
+
 def brain_scene():
     global transparency_mode
     global source_locations
@@ -264,6 +353,7 @@ def brain_scene():
     glScale(zoom_factor, zoom_factor, zoom_factor)
     glRotatef(-90,0,0,1)
     draw_sources()
+    draw_activity()
     #draw_lobes()
     
     if transparency_mode == True:
@@ -280,9 +370,12 @@ def brain_scene():
     glPopMatrix()
     
     # Display info
+    ids = source_ids
     for i, sn in enumerate(source_locations):
        lobe = identify_lobe(sn)
-       display_info(10, screen_h-10 - 20 * len(source_locations) + (i + 1) * 20, 'Source %d: %s (%s)' % (i + 1, lobe[0], lobe[1]))
+       display_info(10, screen_h-10 - 20 * len(source_locations) + (i + 1) * 20, 'Source %d: %s (%s)' % ((ids[i] if i < len(ids) else i) + 1, lobe[0], lobe[1]))
+    if activity_regions:
+        display_info(10, 40, 'Activity: ' + ', '.join('%s %d%%' % (region, 100 * share) for (region, share, peak) in activity_regions[:3]))
     if pause_mode:
         display_info(10, 20 , 'Paused')
     
@@ -302,6 +395,16 @@ def idle():
     '''
     Computation to be performed during idle
     '''
+    global brain
+    global model_loader
+    
+    # Display list has to be built in the GL thread once the model is parsed
+    if model_loader is not None and not model_loader.is_alive():
+        if model_loader.model is not None:
+            brain = model_loader.model
+            brain.compile()
+            startup_step('Model')
+        model_loader = None
     display()
 
 def mouse(button, state, x, y):
@@ -435,7 +538,20 @@ def keyboard(key, x, y):
             print 'Pause mode enabled'
         else:
             print 'Pause mode disabled'
-    
+    elif key == 'l' or key == 'L':
+        print_latency()
+    elif key == 'a' or key == 'A':
+        toggle_activity()
+    
+def toggle_activity():
+    global show_activity
+    global activity
+    global activity_regions
+    show_activity = not show_activity
+    if not show_activity:
+        activity = None
+        activity_regions = []
+
 def change_transparency_mode():
     global transparency_mode
     if transparency_mode == False:
@@ -443,25 +559,37 @@ def change_transparency_mode():
     else:
         transparency_mode = False
 
-def init_model():
+class ModelLoader(Thread):
     '''
-    Load model from Wavefront .obj file
+    Parse Wavefront .obj file in the background
     '''
-    global brain
-    brain = objloader.OBJ('brain_20k_colored_properly.obj', 'model', swapyz=False)
+    model = None
+
+    def run(self):
+        self.model = objloader.OBJ('brain_20k_colored_properly.obj', 'model', swapyz=False, compile=False)
 
 def main():
     '''
     Build the main pipeline
+    Model parsing, device discovery with the first ICA run and window with
+    shader setup all start at once
     '''
-    initepoc()
-    initsourceloc()
+    global model_loader
+    model_loader = ModelLoader()
+    model_loader.daemon = True
+    model_loader.start()
+    pipeline = Thread(target=initpipeline)
+    pipeline.daemon = True
+    pipeline.start()
     initgl()
         
 def draw_brain():
     global p_shader_mode
     global transparency_mode
     
+    if brain is None:
+        return
+    
     glPushMatrix()
     if(transparency_mode == False):
         glUniform1i(p_shader_mode, 2) # xray
@@ -496,11 +624,12 @@ def draw_electrodes():
     # Protecting variables from overwriting by other threads
     mie = copy.deepcopy(most_influential_electrodes)
     sl = copy.deepcopy(source_locations)
+    ids = list(source_ids)
     
-    for electrode,coordinate in enumerate(epoc.coordinates):     
+    for electrode,coordinate in enumerate(Epoc.coordinates):     
         if mie.has_key(electrode):           
             for contributed_source in mie[electrode]:
-                line_color = get_color(contributed_source)
+                line_color = get_color(ids[contributed_source] if contributed_source < len(ids) else contributed_source)
                 draw_electrode(coordinate[0], coordinate[1], line_color)
                 if transparency_mode:
                     draw_connecting_line(coordinate[0],sl[contributed_source], line_color)
@@ -508,18 +637,14 @@ def draw_electrodes():
             draw_electrode(coordinate[0], coordinate[1], [0.9, 0.9, 0.9, 1])
     glPopMatrix()
 
+source_colors = [[0.9, 0.4, 0.4, 1],
+                 [0.96, 0.64, 0.38, 1],
+                 [0.0, 0.5, 0.0, 1],
+                 [0.94, 0.5, 0.5, 1],
+                 [0.29, 0, 0.5, 1]]
+
 def get_color(index):
-    if index == 0:
-        line_color = list([0.9, 0.4, 0.4,1])
-    elif index == 1:
-        line_color = list([0.96, 0.64, 0.38,1])
-    elif index == 2:
-        line_color = list([0.0, 0.5, 0.0,1])
-    elif index == 3:
-        line_color = list([0.94, 0.5, 0.5,1])
-    elif index == 4:
-        line_color = list([0.29, 0, 0.5,1])
-    return line_color
+    return list(source_colors[index % len(source_colors)])
     
 def draw_connecting_line(electrod_coordinates, source_coordinates, color):
     global connecting_line_width
@@ -584,20 +709,33 @@ def localize_sources():
     '''
     global localizer
     global source_locations
+    global source_ids
     global sample_sec
     global localizer_thread_alive
     global influential_per_source
     global most_influential_electrodes
     global pause_mode
+    global pending_trace
     
+    first_sources = True
     while localizer_thread_alive:
-        localizer.set_data(epoc.read_next_sample())
+        # Wakes up now and then to notice quit, and at once when the reader stops
+        window = epoc.read_next_sample(timeout=1.0)
+        if window is None:
+            continue
+        origin = epoc.window_time
+        started = clock()
+        latency.record('acquire', started - origin)
+        filtered = stream_filter.update(window, epoc.new_samples)
+        prepared = clock()
+        latency.record('filter', prepared - started)
+        localizer.set_data(filtered, epoc.new_samples)
         localizer.ica()  
-        locations = []
+        unmixed = clock()
+        latency.record('ica', unmixed - prepared)
+        (locations, fit) = localizer.localize_all()
         influential_electrodes = {}
-        for sn in range(localizer.number_of_sources):           
-            locations.append(localizer.localize(sn))
-            
+        for sn in range(len(locations)):           
             contributions = []
             for j in range(len(localizer.mixing_matrix)):
                 contributions.append(localizer.mixing_matrix[j][sn]**2)
@@ -609,14 +747,70 @@ def localize_sources():
                     influential_electrodes[electrode] = []
                 influential_electrodes[electrode].append(sn)
                 
+        if show_activity:
+            scan_activity()
+
+        localized = clock()
+        latency.record('localize', localized - unmixed)
+
         if pause_mode == 0:       
             most_influential_electrodes = influential_electrodes
+            source_ids = list(localizer.component_ids)
             source_locations = locations
+            pending_trace = (origin, clock())
+
+        if first_sources:
+            first_sources = False
+            startup_step('First sources')
 
         # Hand-picked 1-second delay for larger windows
         # TODO: estimate it in runtime
         #time.sleep(2.0)
 
+def scan_activity():
+    '''
+    Power of every voxel inside the brain for the current window, from the beamformer or the inverse operator
+    '''
+    global activity_scanner
+    global activity_grid
+    global activity
+    global activity_regions
+    
+    if activity_scanner is None:
+        electrodes = [c[0] for c in Epoc.coordinates]
+        activity_grid = SourceGrid(electrodes, head=SphericalHead(electrodes) if forward_model == 'sphere' else None)
+        if activity_engine == 'beamformer':
+            activity_scanner = Beamformer(activity_grid.lead_field)
+        else:
+            activity_scanner = InverseOperator(activity_grid.lead_field, activity_grid.points, method=activity_engine)
+    if activity_engine == 'beamformer':
+        power = activity_scanner.scan(localizer.data)
+    else:
+        power = activity_scanner.activity(localizer.data)
+    strongest = np.argsort(power)[-int(len(power) * activity_share):]
+    # Activity may have been switched off while scanning
+    if pause_mode == 0 and show_activity:
+        activity = (activity_grid.points[strongest], power[strongest] / power[strongest].max())
+        if activity_engine != 'beamformer':
+            activity_regions = activity_scanner.regions(power, identify_lobe)
+
+def draw_activity():
+    volume = activity
+    if volume is None:
+        return
+
+    glUniform1i(p_shader_mode, 0)
+    glPushMatrix()
+    glMultMatrixf(rotation_matrix.toList())
+    glPointSize(4.0)
+    glBegin(GL_POINTS)
+    for (position, level) in zip(volume[0], volume[1]):
+        glColor3f(1.0, 1.0 - level, 0.0)
+        glVertex3f(position[0], position[1], position[2])
+    glEnd()
+    glPopMatrix()
+    glUniform1i(p_shader_mode, 1)
+
 def draw_sources():
     global source_locations
 
@@ -705,8 +899,10 @@ def quit():
     global localizer_thread_alive
     
     print "Shutting down threads..."
-    epoc.stop_reader()
     localizer_thread_alive = False
+    if epoc is not None:
+        epoc.stop_reader()
+    latency.dump(latency_path)
     sys.exit()
     
 # Start the program
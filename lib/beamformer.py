@@ -0,0 +1,93 @@
+"""
+
+LCMV beamformer over a grid of candidate source positions
+
+    * Spatial filter of every voxel passes a unit source at the voxel and
+      minimizes the output power of everything else, given the data covariance
+    * One inverse of the regularized 14 x 14 covariance serves all voxels,
+      power of the whole grid is a handful of batched array operations
+    * Lead fields are scalar (voxels x electrodes), for a fixed orientation, or
+      vector (voxels x electrodes x 3), where power is summed over orientations
+    * Optionally normalized by the projected noise, the neural activity index,
+      which keeps deep voxels with weak lead fields from dominating
+
+"""
+
+import numpy as np
+
+class Beamformer:
+
+    def __init__(self, lead_field, regularization=0.05, normalize=True):
+        '''
+            lead_field -- (voxels x electrodes) or (voxels x electrodes x 3) contributions of unit sources
+            regularization -- diagonal loading as share of the mean sensor variance
+            normalize -- divide power by the power of uncorrelated unit noise
+        '''
+        self.lead_field = np.asarray(lead_field, dtype=float)
+        self.vector = self.lead_field.ndim == 3
+        if self.vector:
+            # One row per voxel and orientation, filtered by a single matrix product
+            (voxels, electrodes, orientations) = self.lead_field.shape
+            self.rows = np.ascontiguousarray(self.lead_field.transpose(0, 2, 1)).reshape(-1, electrodes)
+        self.regularization = regularization
+        self.normalize = normalize
+
+    def inverse(self, covariance):
+        '''
+        Inverse of the diagonally loaded covariance
+        '''
+        covariance = np.asarray(covariance, dtype=float)
+        loading = self.regularization * np.trace(covariance) / len(covariance)
+        return np.linalg.inv(covariance + loading * np.eye(len(covariance)))
+
+    def power(self, covariance):
+        '''
+        Source power of every voxel for a data covariance (electrodes x electrodes)
+        '''
+        inverse = self.inverse(covariance)
+        if not self.vector:
+            # l^T C^-1 l of every voxel, power is its reciprocal
+            filtered = np.dot(self.lead_field, inverse)
+            gain = np.sum(filtered * self.lead_field, axis=1)
+            power = 1.0 / gain
+            if self.normalize:
+                # Noise power of the same filter, l^T C^-2 l / (l^T C^-1 l)^2
+                power /= np.sum(filtered**2, axis=1) / gain**2
+            return power
+
+        # Orientations as rows, (voxels x 3 x 3) gain matrices inverted in one call
+        filtered = self.filter_rows(inverse)
+        gain = np.matmul(filtered, self.lead_field)
+        gain_inverse = np.linalg.inv(gain)
+        power = np.einsum('vii->v', gain_inverse)
+        if self.normalize:
+            noise = np.matmul(filtered, filtered.transpose(0, 2, 1))
+            power /= np.einsum('vii->v', np.matmul(np.matmul(gain_inverse, noise), gain_inverse))
+        return power
+
+    def filter_rows(self, inverse):
+        '''
+        L^T C^-1 of every voxel (voxels x 3 x electrodes) as one matrix product
+        '''
+        (voxels, electrodes, orientations) = self.lead_field.shape
+        return np.dot(self.rows, inverse).reshape(voxels, orientations, electrodes)
+
+    def weights(self, covariance):
+        '''
+        Spatial filters, (voxels x electrodes) or (voxels x 3 x electrodes)
+        Filtered samples of a window are np.dot(window, weights.T) for scalar lead fields
+        '''
+        inverse = self.inverse(covariance)
+        if not self.vector:
+            filtered = np.dot(self.lead_field, inverse)
+            return filtered / np.sum(filtered * self.lead_field, axis=1)[:, np.newaxis]
+        filtered = self.filter_rows(inverse)
+        return np.matmul(np.linalg.inv(np.matmul(filtered, self.lead_field)), filtered)
+
+    def scan(self, window):
+        '''
+        Power of every voxel for a window of samples (time points x electrodes)
+        '''
+        window = np.asarray(window, dtype=float)
+        centered = window - window.mean(axis=0)
+        return self.power(np.dot(centered.T, centered) / len(window))
@@ -0,0 +1,34 @@
+"""
+
+Files derived from others and kept on disk, like the source grid and the inverse operator
+
+"""
+
+import os
+
+def replace_file(source, target):
+    '''
+    Move source to target, replacing target if it exists
+    Rename replaces atomically on POSIX, on Windows it fails for an existing target, which is removed first
+    '''
+    try:
+        os.rename(source, target)
+    except OSError:
+        if not os.path.exists(target):
+            raise
+        try:
+            os.remove(target)
+        except OSError:
+            # Removed in between by another writer
+            if os.path.exists(target):
+                raise
+        os.rename(source, target)
+
+def write_cache(path, write):
+    '''
+    Write a cache file under a temporary name and rename it, a concurrent reader never sees a partial file
+        write -- function writing the contents into an open binary file
+    '''
+    with open(path + '.part', 'wb') as f:
+        write(f)
+    replace_file(path + '.part', path)
@@ -0,0 +1,68 @@
+"""
+
+Covariance of a sliding window of samples
+
+    * Sums of the samples and of their outer products are updated with the
+      rows that enter and leave the window, instead of a pass over the window
+    * Sums are taken relative to an offset near the data, so DC offsets of
+      raw EEG do not cancel out the precision, and recomputed from scratch
+      every `recompute` updates against drift
+    * One eigendecomposition of the 14 x 14 result serves both the source
+      count and the whitening
+
+"""
+
+import numpy as np
+
+class SlidingCovariance:
+
+    def __init__(self, recompute=64):
+        self.recompute = recompute
+        self.history = None
+        self.updates = 0
+
+    def reset(self, window):
+        window = np.asarray(window, dtype=float)
+        self.history = window.copy()
+        self.offset = window.mean(axis=0)
+        shifted = window - self.offset
+        self.sum = shifted.sum(axis=0)
+        self.products = np.dot(shifted.T, shifted)
+        self.updates = 0
+
+    def update(self, window, new_samples=None):
+        '''
+        Follow the window, of which only the last new_samples rows are new
+        All rows are taken as new if new_samples is None
+        '''
+        n = len(window) if new_samples is None else new_samples
+        if (self.history is None or self.history.shape != np.shape(window) or n >= len(window)
+                or self.updates >= self.recompute):
+            self.reset(window)
+            return
+        if n <= 0:
+            return
+        leaving = self.history[:n] - self.offset
+        entering = np.asarray(window[len(window) - n:], dtype=float) - self.offset
+        self.sum += entering.sum(axis=0) - leaving.sum(axis=0)
+        self.products += np.dot(entering.T, entering) - np.dot(leaving.T, leaving)
+        self.history[:-n] = self.history[n:]
+        self.history[-n:] = entering + self.offset
+        self.updates += 1
+
+    def mean(self):
+        return self.offset + self.sum / len(self.history)
+
+    def covariance(self):
+        '''
+        Biased covariance of the window
+        '''
+        N = len(self.history)
+        return (self.products - np.outer(self.sum, self.sum) / N) / N
+
+    def eigen(self):
+        '''
+        Eigenvalues and eigenvectors of the covariance, largest first
+        '''
+        (eigenvalues, eigenvectors) = np.linalg.eigh(self.covariance())
+        return np.maximum(eigenvalues[::-1], 0), eigenvectors[:, ::-1]
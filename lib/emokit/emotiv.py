@@ -8,10 +8,14 @@ except:
     windows = False
 
 import os
-from gevent.queue import Queue
+import io
+import numpy as np
+from gevent.queue import Queue, Empty, Full
+from gevent.select import select
 from subprocess import check_output
 from Crypto.Cipher import AES
-from Crypto import Random
+# Read times of reports, the clock of the timestamps in the shared sample buffer
+from lib.ringbuffer import clock
 
 sensorBits = {
     'F3': [10, 11, 12, 13, 14, 15, 0, 1, 2, 3, 4, 5, 6, 7],
@@ -31,8 +35,77 @@ sensorBits = {
 }
 quality_bits = [99, 100, 101, 102, 103, 104, 105, 106, 107, 108, 109, 110, 111, 112]
 
+# Order of the sensor columns in decoded batches, same as the montage in Epoc.coordinates
+sensor_order = ['AF3', 'F7', 'F3', 'FC5', 'T7', 'P7', 'O1', 'O2', 'P8', 'T8', 'FC6', 'F4', 'F8', 'AF4']
+_sensor_index = dict((name, i) for i, name in enumerate(sensor_order))
+
+# Byte and bit offsets of every value bit, the first byte of a report is the counter
+_sensor_bits = np.array([sensorBits[name] for name in sensor_order])
+_sensor_bytes, _sensor_shifts = _sensor_bits // 8 + 1, _sensor_bits % 8
+_quality_bytes, _quality_shifts = np.array([quality_bits]) // 8 + 1, np.array([quality_bits]) % 8
+_level_weights = 1 << np.arange(14)
+
+# Sensor whose contact quality is reported in a packet, indexed by the counter byte
+_quality_sensor_table = np.empty(256, dtype=int)
+_quality_sensor_table.fill(-1)
+for _counter, _name in enumerate(['F3', 'FC5', 'AF3', 'F7', 'T7', 'P7', 'O1', 'O2',
+                                  'P8', 'T8', 'F8', 'AF4', 'FC6', 'F4', 'F8', 'AF4']):
+    _quality_sensor_table[_counter] = _sensor_index[_name]
+for _counter, _name in enumerate(['F3', 'FC5', 'AF3', 'F7', 'T7', 'P7', 'O1', 'O2', 'P8',
+                                  'T8', 'F8', 'AF4', 'FC6', 'F4', 'F8', 'AF4', 'FC6']):
+    _quality_sensor_table[64 + _counter] = _sensor_index[_name]
+
+# Battery percentage, indexed by the raw battery byte
+_battery_table = np.zeros(256, dtype=int)
+_battery_table[249:] = 100
+_battery_table[226:248] = [1, 2, 2, 2, 3, 4, 6, 12, 20, 32, 46, 55, 62, 66, 72, 77, 82, 85, 89, 93, 97, 99]
+
+class BoundedQueue(Queue):
+    """
+    Queue with fixed capacity and an overflow policy.
+
+    With 'drop-oldest' or 'drop-newest' a full queue discards an item instead
+    of growing, with 'block' put() waits for room. Items that could not be
+    queued are counted in `dropped`, the largest size seen in `high_water`.
+    """
+
+    policies = ('drop-oldest', 'drop-newest', 'block')
+
+    def __init__(self, capacity, policy='drop-oldest'):
+        Queue.__init__(self)
+        self.configure(capacity, policy)
+        self.dropped = 0
+        self.high_water = 0
+
+    def configure(self, capacity, policy):
+        if policy not in self.policies:
+            raise ValueError('Unknown queue policy %s' % policy)
+        self.capacity = capacity
+        self.policy = policy
+        self.maxsize = capacity if policy == 'block' else None
+
+    def put(self, item, block=True, timeout=None):
+        if self.qsize() >= self.capacity:
+            if self.policy == 'drop-oldest':
+                self.get_nowait()
+                self.dropped += 1
+            elif self.policy == 'drop-newest' or not block:
+                self.dropped += 1
+                return
+        try:
+            Queue.put(self, item, block, timeout)
+        except Full:
+            self.dropped += 1
+            return
+        self.high_water = max(self.high_water, self.qsize())
+
+    def stats(self):
+        return {'size': self.qsize(), 'capacity': self.capacity,
+                'high_water': self.high_water, 'dropped': self.dropped}
+
 g_battery = 0
-tasks = Queue()
+# Blocks of encrypted reports waiting for decryption, with their read times
+tasks = BoundedQueue(1024)
 
 # this is useful for further reverse engineering for EmotivPacket
 byte_names = {
@@ -146,167 +219,138 @@ byte_names = {
     ],
 }
 
-class EmotivPacket(object):
+def crypto_key(sn):
+    '''
+    AES key derived from the serial number of the USB receiver
+    '''
+    type = 0 # feature[5]
+    type &= 0xF
+    type = 0
+    # I believe type == True is for the Dev headset, I'm not using that. That's the point of this library in the first place I thought.
+    k = ['\0'] * 16
+    k[0] = sn[-1]
+    k[1] = '\0'
+    k[2] = sn[-2]
+    if type:
+        k[3] = 'H'
+        k[4] = sn[-1]
+        k[5] = '\0'
+        k[6] = sn[-2]
+        k[7] = 'T'
+        k[8] = sn[-3]
+        k[9] = '\x10'
+        k[10] = sn[-4]
+        k[11] = 'B'
+    else:
+        k[3] = 'T'
+        k[4] = sn[-3]
+        k[5] = '\x10'
+        k[6] = sn[-4]
+        k[7] = 'B'
+        k[8] = sn[-1]
+        k[9] = '\0'
+        k[10] = sn[-2]
+        k[11] = 'H'
+    k[12] = sn[-3]
+    k[13] = '\0'
+    k[14] = sn[-4]
+    k[15] = 'P'
+    return ''.join(k)
+
+class EmotivBatch(object):
     """
-    Basic semantics for input bytes.
+    Decoded block of consecutive decrypted reports.
+
+    All fields are NumPy arrays with one entry per report, sensor levels
+    are stored as an (N, 14) matrix in `sensor_order`. Timestamps are the
+    times the reports were read from the device, if known.
     """
 
-    def __init__(self, data, sensors):
+    def __init__(self, data, timestamps=None):
         global g_battery
-        self.rawData = data
-        self.counter = ord(data[0])
-        self.battery = g_battery
-        if(self.counter > 127):
-            self.battery = self.counter
-            g_battery = self.battery_percent()
-            self.counter = 128
+        self.timestamps = timestamps
+        self.raw = np.frombuffer(data, dtype=np.uint8).reshape(-1, 32)
+        sensor = self.raw[:, 0].astype(int)
+        self.levels = decode_levels(self.raw, _sensor_bytes, _sensor_shifts)
+        self.quality = decode_levels(self.raw, _quality_bytes, _quality_shifts)[:, 0] // 540
+        self.quality_sensor = _quality_sensor_table[sensor]
+
+        # Packets with counter above 127 carry battery level instead of the counter
+        battery_packets = sensor > 127
+        self.counter = np.where(battery_packets, 128, sensor)
         self.sync = self.counter == 0xe9
 
         # the RESERVED byte stores the least significant 4 bits for gyroX and gyroY
-        self.gyroX = ((ord(data[29]) << 4) | (ord(data[31]) >> 4))
-        self.gyroY = ((ord(data[30]) << 4) | (ord(data[31]) & 0x0F))
-        sensors['X']['value'] = self.gyroX
-        sensors['Y']['value'] = self.gyroY
-
-        for name, bits in sensorBits.items():
-            value = self.get_level(self.rawData, bits)
-            setattr(self, name, (value,))
-            sensors[name]['value'] = value
-        self.handle_quality(sensors)
+        self.gyro_x = (self.raw[:, 29].astype(int) << 4) | (self.raw[:, 31] >> 4)
+        self.gyro_y = (self.raw[:, 30].astype(int) << 4) | (self.raw[:, 31] & 0x0F)
+
+        # Carry the last reported battery level forward
+        last_report = np.where(battery_packets, np.arange(len(sensor)), -1)
+        np.maximum.accumulate(last_report, out=last_report)
+        self.battery = np.where(last_report >= 0, _battery_table[sensor[last_report]], g_battery)
+        if len(self.battery) > 0:
+            g_battery = int(self.battery[-1])
+
+    def __len__(self):
+        return len(self.raw)
+
+    def packets(self, sensors=None):
+        return [EmotivPacket(None, sensors, self, i) for i in range(len(self))]
+
+def decode_levels(raw, byte_table, shift_table):
+    '''
+    Decode 14-bit values of all reports at once
+        raw -- (N, 32) array of decrypted reports
+        byte_table, shift_table -- (channels, 14) positions of value bits
+    '''
+    bits = (raw[:, byte_table] >> shift_table) & 1
+    return np.dot(bits, _level_weights)
+
+class EmotivPacket(object):
+    """
+    Basic semantics for input bytes.
+
+    Thin view over one row of an `EmotivBatch`.
+    """
+
+    def __init__(self, data, sensors=None, batch=None, index=0):
+        if batch is None:
+            batch = EmotivBatch(data)
+        self.batch = batch
+        self.index = index
+        self.counter = int(batch.counter[index])
+        self.battery = int(batch.battery[index])
+        self.sync = bool(batch.sync[index])
+        self.gyroX = int(batch.gyro_x[index])
+        self.gyroY = int(batch.gyro_y[index])
+        self.levels = batch.levels[index]
+        if sensors is not None:
+            sensors['X']['value'] = self.gyroX
+            sensors['Y']['value'] = self.gyroY
+            for name, value in zip(sensor_order, self.levels.tolist()):
+                sensors[name]['value'] = value
+            self.handle_quality(sensors)
         self.sensors = sensors
 
-    def get_level(self, data, bits):
-        level = 0
-        for i in range(13, -1, -1):
-            level <<= 1
-            b, o = (bits[i] / 8) + 1, bits[i] % 8
-            level |= (ord(data[b]) >> o) & 1
-        return level
+    @property
+    def rawData(self):
+        return self.batch.raw[self.index].tostring()
+
+    def __getattr__(self, name):
+        if name in _sensor_index:
+            return (int(self.levels[_sensor_index[name]]),)
+        raise AttributeError(name)
 
     def handle_quality(self, sensors):
-        current_contact_quality = self.get_level(self.rawData, quality_bits) / 540
-        sensor = ord(self.rawData[0])
-        if sensor == 0:
-            sensors['F3']['quality'] = current_contact_quality
-        elif sensor == 1:
-            sensors['FC5']['quality'] = current_contact_quality
-        elif sensor == 2:
-            sensors['AF3']['quality'] = current_contact_quality
-        elif sensor == 3:
-            sensors['F7']['quality'] = current_contact_quality
-        elif sensor == 4:
-            sensors['T7']['quality'] = current_contact_quality
-        elif sensor == 5:
-            sensors['P7']['quality'] = current_contact_quality
-        elif sensor == 6:
-            sensors['O1']['quality'] = current_contact_quality
-        elif sensor == 7:
-            sensors['O2']['quality'] = current_contact_quality
-        elif sensor == 8:
-            sensors['P8']['quality'] = current_contact_quality
-        elif sensor == 9:
-            sensors['T8']['quality'] = current_contact_quality
-        elif sensor == 10:
-            sensors['F8']['quality'] = current_contact_quality
-        elif sensor == 11:
-            sensors['AF4']['quality'] = current_contact_quality
-        elif sensor == 12:
-            sensors['FC6']['quality'] = current_contact_quality
-        elif sensor == 13:
-            sensors['F4']['quality'] = current_contact_quality
-        elif sensor == 14:
-            sensors['F8']['quality'] = current_contact_quality
-        elif sensor == 15:
-            sensors['AF4']['quality'] = current_contact_quality
-        elif sensor == 64:
-            sensors['F3']['quality'] = current_contact_quality
-        elif sensor == 65:
-            sensors['FC5']['quality'] = current_contact_quality
-        elif sensor == 66:
-            sensors['AF3']['quality'] = current_contact_quality
-        elif sensor == 67:
-            sensors['F7']['quality'] = current_contact_quality
-        elif sensor == 68:
-            sensors['T7']['quality'] = current_contact_quality
-        elif sensor == 69:
-            sensors['P7']['quality'] = current_contact_quality
-        elif sensor == 70:
-            sensors['O1']['quality'] = current_contact_quality
-        elif sensor == 71:
-            sensors['O2']['quality'] = current_contact_quality
-        elif sensor == 72:
-            sensors['P8']['quality'] = current_contact_quality
-        elif sensor == 73:
-            sensors['T8']['quality'] = current_contact_quality
-        elif sensor == 74:
-            sensors['F8']['quality'] = current_contact_quality
-        elif sensor == 75:
-            sensors['AF4']['quality'] = current_contact_quality
-        elif sensor == 76:
-            sensors['FC6']['quality'] = current_contact_quality
-        elif sensor == 77:
-            sensors['F4']['quality'] = current_contact_quality
-        elif sensor == 78:
-            sensors['F8']['quality'] = current_contact_quality
-        elif sensor == 79:
-            sensors['AF4']['quality'] = current_contact_quality
-        elif sensor == 80:
-            sensors['FC6']['quality'] = current_contact_quality
+        current_contact_quality = int(self.batch.quality[self.index])
+        channel = self.batch.quality_sensor[self.index]
+        if channel >= 0:
+            sensors[sensor_order[channel]]['quality'] = current_contact_quality
         else:
             sensors['Unknown']['quality'] = current_contact_quality
-            sensors['Unknown']['value'] = sensor
+            sensors['Unknown']['value'] = int(self.batch.raw[self.index, 0])
         return current_contact_quality
 
-    def battery_percent(self):
-        if self.battery > 248:
-            return 100
-        elif self.battery == 247:
-            return 99
-        elif self.battery == 246:
-            return 97
-        elif self.battery == 245:
-            return 93
-        elif self.battery == 244:
-            return 89
-        elif self.battery == 243:
-            return 85
-        elif self.battery == 242:
-            return 82
-        elif self.battery == 241:
-            return 77
-        elif self.battery == 240:
-            return 72
-        elif self.battery == 239:
-            return 66
-        elif self.battery == 238:
-            return 62
-        elif self.battery == 237:
-            return 55
-        elif self.battery == 236:
-            return 46
-        elif self.battery == 235:
-            return 32
-        elif self.battery == 234:
-            return 20
-        elif self.battery == 233:
-            return 12
-        elif self.battery == 232:
-            return 6
-        elif self.battery == 231:
-            return 4
-        elif self.battery == 230:
-            return 3
-        elif self.battery == 229:
-            return 2
-        elif self.battery == 228:
-            return 2
-        elif self.battery == 227:
-            return 2
-        elif self.battery == 226:
-            return 1
-        else:
-            return 0
-
     def __repr__(self):
         return 'EmotivPacket(counter=%i, battery=%i, gyroX=%i, gyroY=%i, F3=%i)' % (
             self.counter,
@@ -317,9 +361,18 @@ class EmotivPacket(object):
             )
 
 class Emotiv(object):
-    def __init__(self, displayOutput=False, headsetId=0, research_headset=True):
+    def __init__(self, displayOutput=False, headsetId=0, research_headset=True, devicePath=None, serialNum=None,
+                 queueSize=1024, queuePolicy='drop-oldest'):
         self._goOn = True
-        self.packets = Queue()
+        # Explicit device skips hidraw discovery, e.g. for the simulator
+        self.devicePath = devicePath
+        self.serialNum = serialNum
+        # Both acquisition stages hold at most queueSize blocks of reports
+        tasks.configure(queueSize, queuePolicy)
+        self.packets = BoundedQueue(queueSize, queuePolicy)
+        self.pending = None
+        self.pendingIndex = 0
+        self.maxReports = 64
         self.packetsReceived = 0
         self.packetsProcessed = 0
         self.battery = 0
@@ -430,7 +483,8 @@ class Emotiv(object):
             gevent.spawn(self.updateStdout)
             while self._goOn:
                 try:
-                    gevent.sleep(0)
+                    # Reports arrive through handler() on the HID thread, just keep the hub ticking
+                    gevent.sleep(1.0 / 128)
                 except KeyboardInterrupt:
                     self._goOn = False
                     for device in devices:
@@ -441,95 +495,107 @@ class Emotiv(object):
 
     def handler(self, data):
         assert data[0] == 0
-        tasks.put_nowait(''.join(map(chr, data[1:])))
+        tasks.put_nowait((''.join(map(chr, data[1:])), np.array([clock()])))
         self.packetsReceived += 1
         return True
 
     def setupPosix(self):
         _os_decryption = False
-        if os.path.exists('/dev/eeg/raw'):
+        if self.devicePath is not None:
+            path = self.devicePath
+        elif os.path.exists('/dev/eeg/raw'):
             # The decrpytion is handled by the Linux epoc daemon. We don't need to handle it there.
             _os_decryption = True
-            self.hidraw = open("/dev/eeg/raw")
+            path = "/dev/eeg/raw"
         else:
             setup = self.getLinuxSetup()
             self.serialNum = setup[0]
             if os.path.exists("/dev/" + setup[1]):
-                self.hidraw = open("/dev/" + setup[1])
+                path = "/dev/" + setup[1]
             else:
-                self.hidraw = open("/dev/hidraw4")
+                path = "/dev/hidraw4"
+        if not _os_decryption:
             gevent.spawn(self.setupCrypto, self.serialNum)
             gevent.spawn(self.updateStdout)
+        self.hidraw = io.FileIO(os.open(path, os.O_RDONLY | os.O_NONBLOCK), 'r')
+
+        # Reports are read into a preallocated buffer and handed on as one block
+        reports = bytearray(32 * self.maxReports)
+        readTimes = np.zeros(self.maxReports)
+        view = memoryview(reports)
+        filled = 0
         while self._goOn:
             try:
-                data = self.hidraw.read(32)
-                if data != "":
+                # Sleep until the device has data, other greenlets keep running
+                readable, _, _ = select([self.hidraw], [], [], 1.0)
+                if not readable:
+                    continue
+                while filled + 32 <= len(reports):
+                    n = self.hidraw.readinto(view[filled:filled + 32])
+                    if n is None:
+                        break
+                    if n == 0:
+                        self._goOn = False
+                        break
+                    filled += n
+                    if filled % 32 == 0:
+                        readTimes[filled // 32 - 1] = clock()
+                complete = filled - filled % 32
+                if complete > 0:
+                    data = str(reports[:complete])
+                    times = readTimes[:complete // 32].copy()
                     if _os_decryption:
-                        self.packets.put_nowait(EmotivPacket(data))
+                        self.packets.put(EmotivBatch(data, times))
                     else:
                         # Queue it!
-                        self.packetsReceived += 1
-                        tasks.put_nowait(data)
-                        gevent.sleep(0)
+                        self.packetsReceived += complete / 32
+                        tasks.put((data, times))
+                    reports[:filled - complete] = reports[complete:filled]
+                    filled -= complete
             except KeyboardInterrupt:
                 self._goOn = False
         return True
 
     def setupCrypto(self, sn):
-        type = 0 # feature[5]
-        type &= 0xF
-        type = 0
-        # I believe type == True is for the Dev headset, I'm not using that. That's the point of this library in the first place I thought.
-        k = ['\0'] * 16
-        k[0] = sn[-1]
-        k[1] = '\0'
-        k[2] = sn[-2]
-        if type:
-            k[3] = 'H'
-            k[4] = sn[-1]
-            k[5] = '\0'
-            k[6] = sn[-2]
-            k[7] = 'T'
-            k[8] = sn[-3]
-            k[9] = '\x10'
-            k[10] = sn[-4]
-            k[11] = 'B'
-        else:
-            k[3] = 'T'
-            k[4] = sn[-3]
-            k[5] = '\x10'
-            k[6] = sn[-4]
-            k[7] = 'B'
-            k[8] = sn[-1]
-            k[9] = '\0'
-            k[10] = sn[-2]
-            k[11] = 'H'
-        k[12] = sn[-3]
-        k[13] = '\0'
-        k[14] = sn[-4]
-        k[15] = 'P'
+        key = crypto_key(sn)
         # It doesn't make sense to have more than one greenlet handling this as data needs to be in order anyhow. I guess you could assign an ID or something
         # to each packet but that seems like a waste also or is it? The ID might be useful if your using multiple headsets or usb sticks.
-        key = ''.join(k)
-        iv = Random.new().read(AES.block_size)
-        cipher = AES.new(key, AES.MODE_ECB, iv)
-        #for i in k: print "0x%.02x " % (ord(i))
+        # ECB has no IV, blocks are independent so any number of reports decrypt in one call
+        cipher = AES.new(key, AES.MODE_ECB)
         while self._goOn:
+            # Block until reports arrive, then take everything else already queued
+            pending = [tasks.get()]
             while not tasks.empty():
-                task = tasks.get()
-                data = cipher.decrypt(task[:16]) + cipher.decrypt(task[16:])
-                self.lastPacket = EmotivPacket(data, self.sensors)
-                self.packets.put_nowait(self.lastPacket)
-                self.packetsProcessed += 1
-                gevent.sleep(0)
-            gevent.sleep(0)
+                pending.append(tasks.get_nowait())
+            data = cipher.decrypt(''.join(task[0] for task in pending))
+            batch = EmotivBatch(data, np.concatenate([task[1] for task in pending]))
+            self.packets.put(batch)
+            self.packetsProcessed += len(batch)
+
+    def queue_stats(self):
+        return {'tasks': tasks.stats(), 'packets': self.packets.stats()}
 
     def dequeue(self):
         try:
-            return self.packets.get()
+            if self.pending is None or self.pendingIndex == len(self.pending):
+                self.pending = self.packets.get()
+                self.pendingIndex = 0
+            self.lastPacket = EmotivPacket(None, self.sensors, self.pending, self.pendingIndex)
+            self.pendingIndex += 1
+            return self.lastPacket
         except Exception, e:
             print e
 
+    def dequeue_batch(self, timeout=None):
+        '''
+        Next block of decoded reports, None if nothing arrived within timeout
+        Not to be mixed with dequeue()
+        '''
+        try:
+            return self.packets.get(timeout=timeout)
+        except Empty:
+            return None
+
     def close(self):
         if windows:
             self.device.close()
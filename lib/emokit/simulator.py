@@ -0,0 +1,124 @@
+"""
+Encrypted hidraw simulator
+
+Plays a recording as encrypted 32-byte EPOC reports into a FIFO (POSIX only)
+that stands in for /dev/hidrawN, so the whole acquisition path (read loop, decryption,
+decoding, hand-off to Epoc) runs without the headset.
+
+    python -m lib.emokit.simulator [recording] [rate]
+
+then start the application with Epoc(..., device=(simulator path, serial)).
+"""
+
+import os
+import errno
+import time
+import threading
+import numpy as np
+from Crypto.Cipher import AES
+
+from .emotiv import crypto_key, sensorBits, sensor_order
+
+# Position of every value bit inside a report, see emotiv.decode_levels
+_bit_positions = np.array([sensorBits[name] for name in sensor_order]) + 8
+_byte_weights = 1 << np.arange(8)
+
+def encode_levels(levels, counters):
+    '''
+    Build plain reports from (N, 14) sensor levels in sensor_order
+    '''
+    levels = np.clip(np.rint(levels), 0, (1 << 14) - 1).astype(int)
+    bits = np.zeros((len(levels), 32 * 8), dtype=np.uint8)
+    bits[:, _bit_positions] = (levels[:, :, np.newaxis] >> np.arange(14)) & 1
+    raw = np.dot(bits.reshape(-1, 32, 8), _byte_weights).astype(np.uint8)
+    raw[:, 0] = counters
+    # Gyro at rest
+    raw[:, 29] = raw[:, 30] = 0x80
+    return raw
+
+class HidrawSimulator(object):
+    """
+    Emits encrypted reports of a recording into a FIFO at a fixed rate.
+    """
+
+    def __init__(self, recording, path='/tmp/emotiv-hidraw', serial='SN201303150000A1', rate=128.0, chunk=16):
+        self.recording = recording
+        self.path = path
+        self.serial = serial
+        self.rate = rate
+        self.chunk = chunk
+        self.cipher = AES.new(crypto_key(serial), AES.MODE_ECB)
+        self.reportsSent = 0
+        self.reportsDropped = 0
+        self._goOn = False
+        self.thread = None
+
+    def start(self):
+        if not os.path.exists(self.path):
+            os.mkfifo(self.path)
+        # Holding a read-write handle keeps the FIFO open without a reader,
+        # like the device, reports that do not fit into the pipe are lost
+        self.fd = os.open(self.path, os.O_RDWR | os.O_NONBLOCK)
+        self._goOn = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self._goOn = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+            os.close(self.fd)
+
+    def reports(self, start, n):
+        '''
+        Encrypted reports for samples [start, start + n) of the looped recording
+        '''
+        rows = np.arange(start, start + n)
+        samples = self.recording.samples[rows % len(self.recording)]
+        # Counter runs 0..127, every 129th report carries the battery level instead
+        counters = rows % 129
+        raw = encode_levels(samples, np.where(counters == 128, 247, counters))
+        return self.cipher.encrypt(raw.tostring())
+
+    def run(self):
+        origin = time.time()
+        position = 0
+        unsent = ''
+        while self._goOn:
+            due = int((time.time() - origin) * self.rate) - position
+            if due <= 0:
+                time.sleep(min(self.chunk / self.rate, 0.01))
+                continue
+            n = min(due, self.chunk * 8)
+            data = unsent + self.reports(position, n)
+            position += n
+            try:
+                written = os.write(self.fd, data)
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+                written = 0
+            # A partially written report is finished first, whole reports that did not fit are lost
+            rest = len(data) - written
+            unsent = data[written:written + rest % 32]
+            self.reportsDropped += rest // 32
+            self.reportsSent = position - self.reportsDropped - (1 if unsent else 0)
+
+if __name__ == "__main__":
+    import sys
+    from lib.epoc import Epoc
+    from lib import recording
+    path = sys.argv[1] if len(sys.argv) > 1 else Epoc.dummy_file
+    rate = float(sys.argv[2]) if len(sys.argv) > 2 else 128.0
+    rec = recording.open_recording(path, [c[1] for c in Epoc.coordinates], [c[0] for c in Epoc.coordinates])
+    simulator = HidrawSimulator(rec, rate=rate)
+    simulator.start()
+    print "Simulating %s at %.0f Hz on %s (serial %s)" % (path, rate, simulator.path, simulator.serial)
+    try:
+        while True:
+            time.sleep(1)
+            print "Reports sent: %s dropped: %s" % (simulator.reportsSent, simulator.reportsDropped)
+    except KeyboardInterrupt:
+        simulator.stop()
@@ -4,18 +4,38 @@ Communication with Emotiv EPOC device
 
 """
 
-from lib.emokit import emotiv
-import gevent
+from lib.ringbuffer import RingBuffer, clock
+from lib.replay import Replay
+from lib.integrity import PacketMonitor
+from lib import recording
 import numpy as np
 import time
-from multiprocessing import Process, Queue, Value
-    
-def epoc_reader(queue, alive):
+from multiprocessing import Process, Value, Event, RawArray
+
+# Queues inside the reader process whose statistics are published to Epoc
+reader_queues = ('tasks', 'packets')
+
+def epoc_reader(buffer, alive, record_path=None, device=None, ready=None, stats=None, queue_policy='drop-oldest',
+                link=None, fill_gaps=True):
     '''
     Self-contained function to read Emotiv EPOC device
     Is run as separate process using multiprocessing module
+    If record_path is given the session is also streamed to disk
+    device -- optional (path, serial number) to use instead of hidraw discovery
+    ready -- event set once the device is open
+    stats -- shared array receiving high-water mark and drop count of every reader queue
+    queue_policy -- overflow policy of the reader queues, see emotiv.BoundedQueue
+    link -- shared array receiving the PacketMonitor statistics
+    fill_gaps -- interpolate short runs of lost reports in the sample buffer
     '''
-    headset = emotiv.Emotiv()
+    # Device libraries are only needed in the reader process
+    from lib.emokit import emotiv
+    import gevent
+
+    if device is not None:
+        headset = emotiv.Emotiv(devicePath=device[0], serialNum=device[1], queuePolicy=queue_policy)
+    else:
+        headset = emotiv.Emotiv(queuePolicy=queue_policy)
     g = gevent.spawn(headset.setup)
     gevent.sleep(0.1)
     # If process has finished then something went wrong
@@ -23,11 +43,37 @@ def epoc_reader(queue, alive):
         return -1
     else:
         print 'Emotiv EPOC reader process is running'
+        if ready is not None:
+            ready.set()
+        recorder = None
+        if record_path is not None:
+            recorder = recording.SessionRecorder(record_path,
+                                                 [c[1] for c in Epoc.coordinates], 128,
+                                                 [c[0] for c in Epoc.coordinates])
+        monitor = PacketMonitor(max_fill=PacketMonitor.max_fill if fill_gaps else 0)
         while alive.value == True:
-            packet = headset.dequeue()
-            if queue is not None:
-                queue.put(packet)
-            gevent.sleep(0)
+            batch = headset.dequeue_batch(timeout=1.0)
+            if batch is None:
+                continue
+            timestamps = batch.timestamps
+            if timestamps is None:
+                timestamps = np.repeat(clock(), len(batch))
+            # Recording keeps the reports as received, the buffer gets the repaired stream
+            if recorder is not None:
+                recorder.add(batch.levels, batch.counter, batch.quality_sensor, batch.quality, timestamps)
+            (samples, counters, times) = monitor.process(batch.levels, batch.counter, timestamps)
+            if buffer is not None:
+                buffer.write(samples, counters, times)
+            if link is not None:
+                monitor.publish(link)
+            if stats is not None:
+                queue_stats = headset.queue_stats()
+                for i, name in enumerate(reader_queues):
+                    stats[2 * i] = queue_stats[name]['high_water']
+                    stats[2 * i + 1] = queue_stats[name]['dropped']
+        if recorder is not None:
+            recorder.close()
+            print 'Session recorded to %s (%d samples dropped)' % (record_path, recorder.dropped)
         print 'Emotiv EPOC reader process has stopped'
 
 class Epoc:
@@ -35,10 +81,28 @@ class Epoc:
     sample = None
     sample_sec = 0
     sample_size = 0
+    hop_size = 0
+    sliding = False
+    new_samples = 0
+    overruns = 0
+    # Hops a slow consumer may fall behind before the sliding window skips to the newest samples
+    max_backlog = 2
+    buffer_sec = 60
+    discovery_timeout = 2.0
+    last_sample = 0
     dummy = False
+    replay_speed = 1.0
+    dummy_file = 'data/201305161823-KT-mental-3-240.csv'
+    replay = None
     epoc_reader_process = Process()
-    epoc_packet_queue = Queue()
+    epoc_buffer = None
     epoc_process_alive = Value('b', True)
+    epoc_reader_ready = None
+    epoc_reader_stats = None
+    epoc_link_stats = None
+    window_counters = None
+    window_timestamps = None
+    window_time = 0
     
     coordinates = [([-38.4,  68.6,   1.0], 'AF3'), # AF3  (1)
                    ([-69.6,  36.2,   2.6], 'F7'),  # F7   (2)
@@ -55,76 +119,139 @@ class Epoc:
                    ([ 69.6,  36.2,   2.6], 'F8'),  # F8  (13)
                    ([ 38.4,  68.6,   1.0], 'AF4')] # AF4 (14)
     
-    def __init__(self, sample_sec):
+    def __init__(self, sample_sec, hop_sec=None, record_path=None, replay_path=None, replay_speed=1.0, device=None,
+                 queue_policy='drop-oldest', fill_gaps=True, wait_device=True):
+        '''
+            sample_sec -- length of the window returned by read_next_sample
+            hop_sec -- if given, consecutive windows overlap and advance by this step
+            record_path -- if given, the device session is recorded to this file
+            replay_path -- if given, this recording is played instead of the device
+            replay_speed -- replay pace, 1.0 is real time, None is as fast as possible
+            device -- (path, serial number) of the headset, e.g. of lib.emokit.simulator
+            queue_policy -- 'drop-oldest', 'drop-newest' or 'block' when a stage falls behind
+            fill_gaps -- interpolate short runs of lost reports, see lib.integrity
+            wait_device -- wait for the device here, otherwise the caller calls wait_device
+        '''
 
         self.sample_sec = sample_sec
+        self.replay_speed = replay_speed
         self.sample_size = int(128 * float(sample_sec))
+        self.sliding = hop_sec is not None
+        self.hop_size = int(128 * float(hop_sec)) if self.sliding else self.sample_size
+        self.epoc_buffer = RingBuffer(128 * self.buffer_sec, len(self.coordinates), queue_policy)
+        self.epoc_reader_stats = RawArray('L', 2 * len(reader_queues))
+        self.epoc_link_stats = RawArray('d', len(PacketMonitor.fields))
     
+        if replay_path is not None:
+            self.start_replay(replay_path, replay_speed)
+            return
+
         # Start reading the signal
-        self.epoc_reader_process = Process(target=epoc_reader, args=(self.epoc_packet_queue, self.epoc_process_alive))
+        self.epoc_reader_ready = Event()
+        self.epoc_reader_process = Process(target=epoc_reader, args=(self.epoc_buffer, self.epoc_process_alive,
+                                                                         record_path, device, self.epoc_reader_ready,
+                                                                         self.epoc_reader_stats, queue_policy,
+                                                                         self.epoc_link_stats, fill_gaps))
         self.epoc_reader_process.start()
-        
-        # Wait a bit to see if we can find the device
+        if wait_device:
+            self.wait_device()
+
+    def wait_device(self):
+        '''
+        Wait until the reader opened the device, fall back to the dummy recording if there is none
+        '''
+        if self.dummy:
+            return
+
+        # Reader signals as soon as the device is open and exits if there is none
         print 'Looking for device'
-        time.sleep(2.0)
+        deadline = time.time() + self.discovery_timeout
+        while self.epoc_reader_process.is_alive() and time.time() < deadline:
+            if self.epoc_reader_ready.wait(0.01):
+                break
         
-        # If reader process has exited, then device was not found
-        if self.epoc_reader_process.exitcode is not None:
-            self.dummy = True
+        if not self.epoc_reader_ready.is_set():
+            if self.epoc_reader_process.is_alive():
+                self.epoc_reader_process.terminate()
             print 'Could not connect to the device. Running with dummy data.'
-        
-            # Load dummy data
-            f = open('data/201305182224-DF-facial-3-420.csv').readlines()
-            self.lines = [map(float, ln.split(',')) for ln in f]
-            self.lines = np.asarray(self.lines)
-            self.lines = np.delete(self.lines, [14,15,16], axis=1) # delete last 2 columns
-            self.lastline = 0
-
-    def read_next_sample(self):
-    
-        if self.dummy == True:
-        
-            # Read pre-recorded data from file
-            if self.lastline + self.sample_size >= self.lines.shape[0]:
-                self.lastline = 0 
-            self.lastline += self.sample_size
-            return self.lines[self.lastline:self.lastline + self.sample_size]
-            
+            self.start_replay(self.dummy_file, self.replay_speed)
+
+    def start_replay(self, path, speed):
+        '''
+        Play a recording into the sample buffer in place of the device
+        CSV is converted to binary recording on first use
+        '''
+        self.dummy = True
+        self.recording = recording.open_recording(path,
+                                                  [c[1] for c in self.coordinates],
+                                                  [c[0] for c in self.coordinates])
+        self.replay = Replay(self.recording, self.epoc_buffer, speed)
+        self.replay.start()
+
+    def read_next_sample(self, timeout=None):
+        '''
+        Return next window of samples, rows are time points, columns are electrodes
+        None if the reader was stopped or no window arrived within timeout seconds
+        Number of rows not seen in the previous window is stored in new_samples,
+        packet counters and read times of the window in window_counters and window_timestamps,
+        read time of the newest report in window_time
+        '''
+
+        if self.sliding:
+
+            # Advance by exactly one hop so no samples are skipped
+            target = max(self.last_sample + self.hop_size, self.sample_size)
+            written = self.epoc_buffer.wait(target, timeout)
+            if written < target:
+                return None
+
+            # Fell behind by more than a few hops, jump to the latest window
+            if written - target > self.max_backlog * self.hop_size:
+                self.overruns += written - target
+                target = written
+            self.new_samples = min(target - self.last_sample, self.sample_size)
+            self.last_sample = target
+            self.epoc_buffer.release(self.last_sample - self.sample_size)
+            (samples, self.window_counters, self.window_timestamps) = self.epoc_buffer.window(self.last_sample, self.sample_size)
+            self.window_time = self.window_timestamps[-1]
+            return samples
+
         else:
         
-            # Read sample of required size
-            data = []
-            while len(data) < self.sample_size:
-                data.append(self.get_packet())
-            
-            # Clear the queue
-            while not self.epoc_packet_queue.empty():
-                self.epoc_packet_queue.get()
-        
-            return data
+            # Wait for a window of fresh samples and hand out the latest one
+            written = self.epoc_buffer.wait(self.last_sample + self.sample_size, timeout)
+            if written < self.last_sample + self.sample_size:
+                return None
+            self.new_samples = min(written - self.last_sample, self.sample_size)
+            self.last_sample = written
+            self.epoc_buffer.release(self.last_sample - self.sample_size)
+            (samples, self.window_counters, self.window_timestamps) = self.epoc_buffer.window(self.last_sample, self.sample_size)
+            self.window_time = self.window_timestamps[-1]
+            return samples
 
-    def get_packet(self):
+    def stats(self):
         '''
-        Get one packet from the device packet queue
+        High-water marks and drop counts of every acquisition stage
+        Reader queues count blocks of reports, the sample buffer counts samples,
+        link holds lost reports and arrival jitter of the device, see lib.integrity
         '''
-        packet = self.epoc_packet_queue.get()
-        return [packet.AF3[0],
-                packet.F7[0],
-                packet.F3[0],
-                packet.FC5[0],
-                packet.T7[0],
-                packet.P7[0],
-                packet.O1[0],
-                packet.O2[0],
-                packet.P8[0],
-                packet.T8[0],
-                packet.FC6[0],
-                packet.F4[0],
-                packet.F8[0],
-                packet.AF4[0]]
-                
+        stats = {}
+        for i, name in enumerate(reader_queues):
+            stats[name] = {'high_water': self.epoc_reader_stats[2 * i],
+                           'dropped': self.epoc_reader_stats[2 * i + 1]}
+        stats['buffer'] = self.epoc_buffer.stats()
+        stats['buffer']['skipped'] = self.overruns
+        stats['link'] = dict(zip(PacketMonitor.fields, self.epoc_link_stats))
+        return stats
+
     def stop_reader(self):
+        # Readers waiting for the next window give up
+        self.epoc_buffer.close()
+        if self.replay is not None:
+            self.replay.stop()
         self.epoc_process_alive.value = False
-        #self.epoc_reader_process.join()
-        self.epoc_reader_process.terminate()
+        if self.epoc_reader_process.is_alive():
+            # Give the reader a moment to flush the session recording
+            self.epoc_reader_process.join(1.0)
+            self.epoc_reader_process.terminate()
             
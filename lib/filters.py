@@ -0,0 +1,70 @@
+"""
+
+Streaming preprocessing of EEG windows
+
+    * DC blocker removes the electrode offsets (~4000-5000) and slow drift
+    * Optional Butterworth band-pass and notch against mains hum
+    * All stages are one cascade of second-order sections filtered for all
+      channels at once, the filter state carries over between calls, so
+      overlapping windows only filter the samples they have not seen
+
+"""
+
+import numpy as np
+
+class StreamingFilter:
+
+    def __init__(self, channels, window, sample_rate=128.0, band=(1.0, 40.0), notch=50.0, order=4, dc_cutoff=0.1):
+        '''
+            channels -- number of columns of the samples
+            window -- number of rows of the filtered window returned by update
+            band -- (low, high) pass band in Hz, None to only remove DC
+            notch -- mains frequency in Hz, None to disable
+            order -- order of the band-pass
+            dc_cutoff -- corner frequency of the DC blocker in Hz
+        '''
+        from scipy import signal
+        self.channels = channels
+        self.sample_rate = sample_rate
+        nyquist = sample_rate / 2.0
+
+        # y[n] = x[n] - x[n-1] + a * y[n-1]
+        a = np.exp(-2 * np.pi * dc_cutoff / sample_rate)
+        sections = [np.array([[1.0, -1.0, 0.0, 1.0, -a, 0.0]])]
+        if band is not None:
+            sections.append(signal.butter(order, [band[0] / nyquist, band[1] / nyquist], btype='bandpass', output='sos'))
+        if notch is not None and notch < nyquist:
+            (b, a) = signal.iirnotch(notch / nyquist, 30.0)
+            sections.append(signal.tf2sos(b, a))
+        self.sos = np.concatenate(sections)
+        self.zi = None
+        self.window = np.zeros((window, channels))
+
+    def process(self, samples):
+        '''
+        Filter the next rows of the stream
+        '''
+        from scipy.signal import sosfilt, sosfilt_zi
+        samples = np.asarray(samples, dtype=float)
+        if len(samples) == 0:
+            return np.zeros((0, self.channels))
+        if self.zi is None:
+            # Start in the steady state of the first sample, no step response from the offset
+            self.zi = sosfilt_zi(self.sos)[:, :, np.newaxis] * samples[0]
+        (filtered, self.zi) = sosfilt(self.sos, samples, axis=0, zi=self.zi)
+        return filtered
+
+    def update(self, window, new_samples):
+        '''
+        Filtered version of a window of which only the last new_samples rows are new
+        The returned array is reused by the next call
+        '''
+        n = min(new_samples, len(self.window))
+        if n > 0:
+            self.window[:-n] = self.window[n:]
+            self.window[-n:] = self.process(window[len(window) - n:])
+        return self.window
+
+    def reset(self):
+        self.zi = None
+        self.window[:] = 0
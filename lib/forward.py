@@ -0,0 +1,262 @@
+"""
+
+Forward model on a grid of candidate source positions
+
+    * Grid points are spaced evenly inside the convex hull of the brain model
+    * Contribution pattern of a unit source at every grid point is computed
+      once, for the heuristic model of SourceLocalizer 1 / (d^2 + 1), or for
+      dipoles of three orientations in a multi-shell spherical head
+    * Locating sources is then one matrix product and an argmin for all
+      sources at once, with the amplitude k solved in closed form
+    * The grid is cached next to the model, keyed by spacing and electrodes
+    * Spherical head potentials follow the series of Zhang (1995), with the
+      Legendre polynomials of all sources and electrodes in one recursion
+
+"""
+
+import os
+import numpy as np
+from lib.cache import write_cache
+
+brain_model = 'model/brain_20k_colored_properly.obj'
+
+def load_vertices(path):
+    '''
+    Vertex positions of a Wavefront .obj file, without the OpenGL loader
+    '''
+    vertices = []
+    for line in open(path):
+        if line.startswith('v '):
+            vertices.append(map(float, line.split()[1:4]))
+    return np.array(vertices)
+
+def hull_grid(vertices, spacing):
+    '''
+    Points of a regular grid that lie inside the convex hull of the vertices
+    '''
+    from scipy.spatial import ConvexHull, Delaunay
+    hull = Delaunay(vertices[ConvexHull(vertices).vertices])
+    axes = [np.arange(low, high + spacing, spacing) for (low, high) in zip(vertices.min(axis=0), vertices.max(axis=0))]
+    points = np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1).reshape(-1, 3)
+    return points[hull.find_simplex(points) >= 0]
+
+def fit_sphere(points):
+    '''
+    Center and radius of the least squares sphere through the points
+    '''
+    points = np.asarray(points, dtype=float)
+    # |p|^2 = 2 p.c + (r^2 - |c|^2) is linear in c and the last term
+    A = np.hstack((2 * points, np.ones((len(points), 1))))
+    solution = np.linalg.lstsq(A, np.sum(points**2, axis=1), rcond=None)[0]
+    center = solution[:3]
+    return center, np.sqrt(solution[3] + np.dot(center, center))
+
+class SphericalHead:
+
+    # Values of the Legendre polynomials kept at once by lead_field
+    block_size = 1 << 20
+
+    def __init__(self, electrodes, radii=(0.84, 0.8667, 0.9467, 1.0), conductivities=(0.33, 1.0, 0.0042, 0.33),
+                 tolerance=1e-6, max_terms=200):
+        '''
+            electrodes -- (electrodes x 3) positions, the scalp is the sphere fitted through them
+            radii -- shells from the inside out (brain, CSF, skull, scalp) relative to the scalp radius
+            conductivities -- of the shells in S/m
+            tolerance -- size of the last series term relative to the first
+            max_terms -- upper limit of the series
+        '''
+        self.electrodes = np.asarray(electrodes, dtype=float)
+        (self.center, self.radius) = fit_sphere(self.electrodes)
+        # Electrodes are projected on the scalp, only their directions matter
+        directions = self.electrodes - self.center
+        self.directions = directions / np.sqrt(np.sum(directions**2, axis=1))[:, np.newaxis]
+        self.radii = np.asarray(radii, dtype=float)
+        self.conductivities = np.asarray(conductivities, dtype=float)
+        self.tolerance = tolerance
+        self.coefficients = self.series_coefficients(max_terms)
+        # (2n + 1) / n f_n of every term, shared by all evaluations
+        n = np.arange(1, max_terms + 1)
+        self.weights = (2 * n + 1.0) / n * self.coefficients
+        # Sources are kept just inside the innermost shell, in mm from the center
+        self.limit = 0.999 * self.radii[0] * self.radius
+
+    def series_coefficients(self, terms):
+        '''
+        f_n of Zhang (1995) for n = 1 .. terms, all 1 for a homogeneous sphere
+        '''
+        n = np.arange(1, terms + 1, dtype=float)
+        (m11, m12, m21, m22) = (np.ones(terms), np.zeros(terms), np.zeros(terms), np.ones(terms))
+        outer = self.radii[-1]
+        for k in range(len(self.radii) - 1):
+            ratio = self.conductivities[k] / self.conductivities[k + 1]
+            (a11, a12) = (n + (n + 1) * ratio, (n + 1) * (ratio - 1) * (outer / self.radii[k])**(2 * n + 1))
+            (a21, a22) = (n * (ratio - 1) * (self.radii[k] / outer)**(2 * n + 1), (n + 1) + n * ratio)
+            (m11, m12, m21, m22) = ((m11 * a11 + m12 * a21) / (2 * n + 1), (m11 * a12 + m12 * a22) / (2 * n + 1),
+                                    (m21 * a11 + m22 * a21) / (2 * n + 1), (m21 * a12 + m22 * a22) / (2 * n + 1))
+        return n / (n * m22 + (n + 1) * m21)
+
+    def clamp(self, positions):
+        '''
+        Positions outside the innermost shell moved onto it along the radius, the positions the model evaluates
+        '''
+        positions = np.atleast_2d(np.asarray(positions, dtype=float))
+        offsets = positions - self.center
+        distances = np.sqrt(np.sum(offsets**2, axis=1))
+        scale = np.minimum(1.0, self.limit / np.maximum(distances, 1e-12))
+        return self.center + offsets * scale[:, np.newaxis]
+
+    def lead_field(self, positions, gradient=False):
+        '''
+        Potential at every electrode of unit dipoles along x, y and z at every position
+        (positions x electrodes x 3), in V for moments in A m and positions in mm
+        Positions outside the innermost shell are evaluated at clamp(positions)
+        With gradient also the derivatives by the position (positions x electrodes x 3 x 3), in V / mm
+        '''
+        positions = self.clamp(positions) - self.center
+        distances = np.sqrt(np.sum(positions**2, axis=1))
+        b = distances / self.radius
+        # At the center the direction drops out of every term that survives
+        radial = positions / np.maximum(distances, 1e-12)[:, np.newaxis]
+
+        # Terms fall off as n^2 b^(n - 1) f_n, stop where the farthest source is converged
+        n = np.arange(1, len(self.coefficients) + 1)
+        bound = n**2 * (2 * n + 1) * b.max()**(n - 1) * np.abs(self.coefficients)
+        below = np.flatnonzero(bound < self.tolerance * bound[0])
+        terms = below[0] + 1 if len(below) else len(n)
+
+        # Polynomials of all terms are kept for a block of positions at a time
+        block = max(1, self.block_size // (4 * terms * len(self.directions)))
+        parts = [self.series(b[i:i + block], radial[i:i + block], terms, gradient) for i in range(0, len(b), block)]
+        if not gradient:
+            return np.concatenate(parts)
+        return np.concatenate([part[0] for part in parts]), np.concatenate([part[1] for part in parts])
+
+    def series(self, b, radial, terms, gradient):
+        '''
+        lead_field of positions at b scalp radii from the center in directions radial, summed up to n = terms
+        '''
+        # cos of the angle between source and electrode, Legendre polynomials P_n and their first and second
+        # derivatives for all terms (terms + 1 x 4 x positions x electrodes), P_n twice so the three recursions
+        # (n + 1) P_n+1 = (2n + 1) cos P_n - n P_n-1, P'_n+1 = P'_n-1 + (2n + 1) P_n, P''_n+1 = P''_n-1 + (2n + 1) P'_n
+        # are one step on contiguous rows
+        cos = np.dot(radial, self.directions.T)
+        i = np.arange(1, terms, dtype=float)[:, np.newaxis, np.newaxis]
+        factors = np.empty((terms - 1, 3) + cos.shape)
+        factors[:, 0] = (2 * i + 1) / (i + 1) * cos
+        factors[:, 1:] = (2 * i + 1)[:, np.newaxis]
+        previous = np.ones((terms - 1, 3, 1, 1))
+        previous[:, 0] = -i / (i + 1)
+        values = np.empty((terms + 1, 4) + cos.shape)
+        (values[0, :2], values[0, 2:]) = (1, 0)
+        (values[1, :2], values[1, 2], values[1, 3]) = (cos, 1, 0)
+        for k in range(1, terms):
+            np.multiply(factors[k - 1], values[k, :3], out=values[k + 1, 1:])
+            values[k + 1, 1:] += previous[k - 1] * values[k - 1, 1:]
+            values[k + 1, 0] = values[k + 1, 1]
+        n = np.arange(2, terms + 1)
+        (p, dp, ddp) = (values[2:, 1], values[2:, 2], values[2:, 3])
+
+        # The n = 1 term is q . r / |r| alone, the others carry b^(n - 2) (positions x terms - 1) and are
+        # multiplied by b after the sums, so their derivatives by b and cos stay finite at the center
+        weights = self.weights[1:terms] * b[:, np.newaxis]**(n - 2)
+        term = n[:, np.newaxis, np.newaxis] * p - cos * dp
+        radial_sum = np.einsum('sn,nse->se', weights, term)
+        electrode_sum = np.einsum('sn,nse->se', weights, dp)
+        # V = q . (b radial_sum r0 / |r0| + (w_1 + b electrode_sum) r / |r|) / (4 pi sigma R^2), R in m
+        scale = 1.0 / (4 * np.pi * self.conductivities[-1] * (self.radius * 1e-3)**2)
+        L = scale * ((b[:, np.newaxis] * radial_sum)[:, :, np.newaxis] * radial[:, np.newaxis, :] +
+                     (self.weights[0] + b[:, np.newaxis] * electrode_sum)[:, :, np.newaxis] * self.directions[np.newaxis, :, :])
+        if not gradient:
+            return L
+
+        (radial_b, electrode_b) = [np.einsum('sn,nse->se', weights * (n - 1), part) for part in (term, dp)]
+        radial_cos = np.einsum('sn,nse->se', weights, (n - 1)[:, np.newaxis, np.newaxis] * dp - cos * ddp)
+        electrode_cos = np.einsum('sn,nse->se', weights, ddp)
+
+        # d b = r0 / |r0| / R, d cos = t / (b R) with t = r / |r| - cos r0 / |r0|, d (q . r0 / |r0|) = (q - (q . r0 / |r0|) r0 / |r0|) / (b R)
+        tangent = self.directions[np.newaxis, :, :] - cos[:, :, np.newaxis] * radial[:, np.newaxis, :]
+        radial_change = (radial_b[:, :, np.newaxis] * radial[:, np.newaxis, :] + radial_cos[:, :, np.newaxis] * tangent)
+        electrode_change = (electrode_b[:, :, np.newaxis] * radial[:, np.newaxis, :] + electrode_cos[:, :, np.newaxis] * tangent)
+        projector = np.eye(3) - radial[:, :, np.newaxis] * radial[:, np.newaxis, :]
+        dL = (radial[:, np.newaxis, :, np.newaxis] * radial_change[:, :, np.newaxis, :] +
+              radial_sum[:, :, np.newaxis, np.newaxis] * projector[:, np.newaxis, :, :] +
+              self.directions[np.newaxis, :, :, np.newaxis] * electrode_change[:, :, np.newaxis, :])
+        return L, dL * (scale / self.radius)
+
+class SourceGrid:
+
+    def __init__(self, electrodes, model=brain_model, spacing=5.0, alpha=0.3, cache=True, head=None):
+        '''
+            electrodes -- (electrodes x 3) positions
+            model -- .obj file whose convex hull bounds the grid
+            spacing -- distance of neighbouring grid points in mm
+            alpha -- weight of the distance penalty, see SourceLocalizer.error
+            head -- SphericalHead for lead fields of three orientations instead of the heuristic model,
+                    the grid is cut to its innermost shell and the distance penalty, which only belongs
+                    to the heuristic model, is left out
+        '''
+        self.electrodes = np.asarray(electrodes, dtype=float)
+        self.alpha = alpha
+        self.head = head
+        self.points = None
+        path = '%s.grid-%g.npz' % (os.path.splitext(model)[0], spacing)
+        if cache and os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(model):
+            cached = np.load(path)
+            if np.array_equal(cached['electrodes'], self.electrodes):
+                self.points = cached['points']
+                self.distances = cached['distances']
+        if self.points is None:
+            self.points = hull_grid(load_vertices(model), spacing)
+            self.distances = np.sum((self.points[:, np.newaxis, :] - self.electrodes[np.newaxis, :, :])**2, axis=2)
+            if cache:
+                write_cache(path, lambda f: np.savez(f, electrodes=self.electrodes, points=self.points, distances=self.distances))
+        if head is not None:
+            # Only points the head evaluates where they are, inside its innermost shell
+            inside = np.sum((self.points - head.center)**2, axis=1) <= head.limit**2
+            (self.points, self.distances) = (self.points[inside], self.distances[inside])
+            # Potentials of the three orientations (points x electrodes x 3), an orthonormal basis
+            # of their span projects the contributions on the best orientation
+            self.lead_field = head.lead_field(self.points)
+            (U, S, V) = np.linalg.svd(self.lead_field, full_matrices=False)
+            self.basis = U
+            # Moment from the projections, V^T diag(1 / S) for every point
+            self.moments = V.transpose(0, 2, 1) / S[:, np.newaxis, :]
+            self.lead_field_t = np.ascontiguousarray(U.transpose(1, 0, 2)).reshape(len(self.electrodes), -1)
+            self.penalty = np.zeros(len(self.points))
+            return
+        # Contribution of a unit source at every grid point (points x electrodes)
+        self.lead_field = 1.0 / (self.distances + 1)
+        self.lead_field_t = np.ascontiguousarray(self.lead_field.T)
+        self.inverse_norms = 1.0 / np.sum(self.lead_field**2, axis=1)
+        self.penalty = self.alpha * np.sum(self.distances + 1, axis=1)
+
+    def __len__(self):
+        return len(self.points)
+
+    def locate(self, contributions):
+        '''
+        Best grid point of every column of contributions (electrodes x sources)
+        Return
+            (positions (sources x 3), k of every source, error of every source)
+            k is the length of the dipole moment for a spherical head
+        '''
+        if self.head is not None:
+            # Sources x points x 3 coordinates in the basis, the error at the best moment is |c|^2 - |U^T c|^2
+            projections = np.dot(contributions.T, self.lead_field_t).reshape(contributions.shape[1], len(self.points), 3)
+            scores = -np.sum(projections**2, axis=2)
+            best = np.argmin(scores, axis=1)
+            sources = np.arange(len(best))
+            errors = np.sum(contributions**2, axis=0) + scores[sources, best]
+            moments = np.einsum('sij,sj->si', self.moments[best], projections[sources, best])
+            return self.points[best], np.sqrt(np.sum(moments**2, axis=1)), errors
+        # Sources x points, so the search runs along contiguous rows
+        projections = np.dot(contributions.T, self.lead_field_t)
+        # Error at the optimal k is |c|^2 - (g.c)^2 / (g.g) plus the distance penalty,
+        # |c|^2 does not depend on the position and is added after the search
+        scores = projections**2
+        scores *= self.inverse_norms
+        np.subtract(self.penalty, scores, out=scores)
+        best = np.argmin(scores, axis=1)
+        sources = np.arange(len(best))
+        errors = np.sum(contributions**2, axis=0) + scores[sources, best]
+        return self.points[best], projections[sources, best] * self.inverse_norms[best], errors
@@ -0,0 +1,155 @@
+"""
+
+Link integrity of the EPOC report stream
+
+    * Every report carries a counter running 0..127, followed by one battery
+      report that decodes as counter 128, so consecutive counters step by one
+      modulo 129
+    * Larger steps are lost reports, a step of zero is a duplicated report
+    * Inter-arrival times of the reports give the jitter of the link, which
+      tells a radio dropout apart from a slow consumer
+    * Short gaps can be filled by linear interpolation so windows keep their
+      time base
+
+"""
+
+import numpy as np
+
+class PacketMonitor:
+
+    modulus = 129
+    rate = 128.0
+    max_fill = 4
+    # Order of the values published by stats(), also used for shared arrays
+    fields = ('received', 'lost', 'duplicates', 'gaps', 'filled', 'wraps',
+              'loss_rate', 'interval', 'jitter', 'max_interval', 'last_gap_time')
+
+    def __init__(self, rate=128.0, max_fill=4, window=1024):
+        '''
+            rate -- nominal report rate of the headset
+            max_fill -- gaps of up to this many reports are interpolated, 0 disables filling
+            window -- number of recent inter-arrival times the timing statistics cover
+        '''
+        self.rate = rate
+        self.max_fill = max_fill
+        self.intervals = np.zeros(window)
+        self.interval_count = 0
+        self.last_counter = None
+        self.last_time = None
+        self.last_row = None
+        self.counts = dict((name, 0) for name in ('received', 'lost', 'duplicates', 'gaps', 'filled', 'wraps'))
+        # Read time of the report after the most recent gap, 0 before any gap
+        self.last_gap_time = 0.0
+
+    def process(self, samples, counters, timestamps):
+        '''
+        Check a block of reports in arrival order
+        Returns (samples, counters, timestamps) with duplicates removed and
+        short gaps filled
+        '''
+        samples = np.asarray(samples, dtype=float)
+        counters = np.asarray(counters).astype(int)
+        timestamps = np.asarray(timestamps, dtype=float)
+        if len(counters) == 0:
+            return samples, counters, timestamps
+        wrapped = (counters[1:] < counters[:-1])
+        if self.last_counter is None:
+            # Nothing is known before the first report, take it as in sequence
+            self.last_counter = (counters[0] - 1) % self.modulus
+            self.last_time = timestamps[0]
+            self.last_row = samples[0]
+        else:
+            wrapped = np.concatenate(([counters[0] < self.last_counter], wrapped))
+
+        previous = np.concatenate(([self.last_counter], counters[:-1]))
+        steps = (counters - previous) % self.modulus
+        self.counts['received'] += len(counters)
+        self.counts['wraps'] += int(np.count_nonzero(wrapped))
+
+        # Same counter twice in a row is a repeated report
+        keep = steps != 0
+        if not keep.all():
+            self.counts['duplicates'] += int(len(keep) - np.count_nonzero(keep))
+            samples, counters, timestamps, steps = samples[keep], counters[keep], timestamps[keep], steps[keep]
+            if len(counters) == 0:
+                return samples, counters, timestamps
+
+        times = np.concatenate(([self.last_time], timestamps))
+        self.add_intervals(np.diff(times))
+
+        # Gaps longer than a whole counter cycle only show up in max_interval
+        missing = steps - 1
+        gaps = np.flatnonzero(missing)
+        if len(gaps) > 0:
+            self.counts['gaps'] += len(gaps)
+            self.counts['lost'] += int(missing[gaps].sum())
+            self.last_gap_time = timestamps[gaps[-1]]
+            if self.max_fill > 0:
+                (samples, counters, timestamps) = self.fill(samples, counters, timestamps, missing, gaps)
+
+        self.last_counter = counters[-1]
+        self.last_time = timestamps[-1]
+        self.last_row = samples[-1]
+        return samples, counters, timestamps
+
+    def fill(self, samples, counters, timestamps, missing, gaps):
+        '''
+        Interpolate the rows of every gap no longer than max_fill
+        '''
+        pieces = ([], [], [])
+        start = 0
+        filled = 0
+        for i in gaps:
+            n = missing[i]
+            if n > self.max_fill:
+                continue
+            if i > 0:
+                (row, counter, time) = (samples[i - 1], counters[i - 1], timestamps[i - 1])
+            else:
+                (row, counter, time) = (self.last_row, self.last_counter, self.last_time)
+            fraction = np.arange(1, n + 1) / float(n + 1)
+            pieces[0].extend((samples[start:i], row + np.outer(fraction, samples[i] - row)))
+            pieces[1].extend((counters[start:i], (counter + np.arange(1, n + 1)) % self.modulus))
+            pieces[2].extend((timestamps[start:i], time + fraction * (timestamps[i] - time)))
+            filled += n
+            start = i
+        if filled == 0:
+            return samples, counters, timestamps
+        pieces[0].append(samples[start:])
+        pieces[1].append(counters[start:])
+        pieces[2].append(timestamps[start:])
+        self.counts['filled'] += filled
+        return np.concatenate(pieces[0]), np.concatenate(pieces[1]), np.concatenate(pieces[2])
+
+    def add_intervals(self, intervals):
+        size = len(self.intervals)
+        intervals = intervals[-size:]
+        index = (self.interval_count + np.arange(len(intervals))) % size
+        self.intervals[index] = intervals
+        self.interval_count += len(intervals)
+
+    def stats(self):
+        '''
+        Counts since the start and timing of the recent reports in seconds
+        jitter is the standard deviation of the inter-arrival time
+        '''
+        stats = dict(self.counts)
+        expected = stats['received'] - stats['duplicates'] + stats['lost']
+        stats['loss_rate'] = stats['lost'] / float(expected) if expected else 0.0
+        recent = self.intervals[:min(self.interval_count, len(self.intervals))]
+        if len(recent) > 0:
+            stats['interval'] = recent.mean()
+            stats['jitter'] = recent.std()
+            stats['max_interval'] = recent.max()
+        else:
+            stats['interval'] = stats['jitter'] = stats['max_interval'] = 0.0
+        stats['last_gap_time'] = self.last_gap_time
+        return stats
+
+    def publish(self, shared):
+        '''
+        Copy stats() into a shared array in the order of `fields`
+        '''
+        stats = self.stats()
+        for i, name in enumerate(self.fields):
+            shared[i] = stats[name]
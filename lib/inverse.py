@@ -0,0 +1,118 @@
+"""
+
+Distributed inverse solutions, minimum norm estimate and sLORETA
+
+    * Current density at every grid point is a linear function of the
+      electrode samples, K = L^T (L L^T + lambda^2 I)^-1 for the lead field L
+    * The montage is fixed, so the operator only depends on lead field and
+      regularization, it is computed once and cached on disk keyed by both
+    * sLORETA standardizes every voxel by its resolution, which removes the
+      depth bias of the minimum norm estimate
+    * Samples and lead field use the average reference
+
+"""
+
+import os
+import hashlib
+import numpy as np
+from lib.cache import write_cache
+
+class InverseOperator:
+
+    methods = ('mne', 'sloreta')
+
+    def __init__(self, lead_field, points, regularization=0.1, method='sloreta', cache_dir='data'):
+        '''
+            lead_field -- (voxels x electrodes) or (voxels x electrodes x 3) contributions of unit sources
+            points -- (voxels x 3) positions of the voxels
+            regularization -- lambda^2 as share of the mean sensor power of the lead field
+            method -- 'mne' or 'sloreta'
+            cache_dir -- directory of the cached operators, None disables the cache
+        '''
+        if method not in self.methods:
+            raise ValueError('Unknown inverse method %s' % method)
+        self.lead_field = np.asarray(lead_field, dtype=float)
+        self.points = np.asarray(points, dtype=float)
+        self.vector = self.lead_field.ndim == 3
+        self.regularization = regularization
+        self.method = method
+        self.labels = None
+
+        key = hashlib.sha1(self.lead_field.tostring() + self.points.tostring() +
+                           repr((regularization, method))).hexdigest()[:16]
+        path = os.path.join(cache_dir, 'inverse-%s.npy' % key) if cache_dir is not None else None
+        if path is not None and os.path.exists(path):
+            self.operator = np.load(path)
+        else:
+            self.operator = self.compute()
+            if path is not None:
+                write_cache(path, lambda f: np.save(f, self.operator))
+
+    def compute(self):
+        '''
+        Rows of the operator, one per voxel or per voxel and orientation (voxels * 3 x electrodes)
+        '''
+        electrodes = self.lead_field.shape[1]
+        if self.vector:
+            rows = self.lead_field.transpose(0, 2, 1).reshape(-1, electrodes)
+        else:
+            rows = self.lead_field
+        # Average reference, the samples get the same in apply
+        rows = rows - rows.mean(axis=1)[:, np.newaxis]
+        gram = np.dot(rows.T, rows)
+        loading = self.regularization * np.trace(gram) / electrodes
+        operator = np.dot(rows, np.linalg.pinv(gram + loading * np.eye(electrodes)))
+
+        if self.method == 'sloreta':
+            # Diagonal of the resolution matrix K L, 3 x 3 blocks for vector lead fields
+            if self.vector:
+                K = operator.reshape(-1, 3, electrodes)
+                L = rows.reshape(-1, 3, electrodes)
+                resolution = np.matmul(K, L.transpose(0, 2, 1))
+                (eigenvalues, eigenvectors) = np.linalg.eigh(resolution)
+                root = np.matmul(eigenvectors / np.sqrt(np.maximum(eigenvalues, 1e-30))[:, np.newaxis, :],
+                                 eigenvectors.transpose(0, 2, 1))
+                operator = np.matmul(root, K).reshape(-1, electrodes)
+            else:
+                operator /= np.sqrt(np.sum(operator * rows, axis=1))[:, np.newaxis]
+        return operator
+
+    def apply(self, samples):
+        '''
+        Current density (time points x voxels, or x voxels x 3) of samples (time points x electrodes)
+        '''
+        samples = np.asarray(samples, dtype=float)
+        density = np.dot(samples - samples.mean(axis=-1)[..., np.newaxis], self.operator.T)
+        if self.vector:
+            return density.reshape(density.shape[:-1] + (-1, 3))
+        return density
+
+    def activity(self, window):
+        '''
+        Power of every voxel over a window (time points x electrodes), summed over orientations
+        '''
+        window = np.asarray(window, dtype=float)
+        centered = window - window.mean(axis=0)
+        centered -= centered.mean(axis=1)[:, np.newaxis]
+        covariance = np.dot(centered.T, centered) / len(window)
+        # diag(K C K^T) without the voxels x voxels product
+        power = np.sum(np.dot(self.operator, covariance) * self.operator, axis=1)
+        if self.vector:
+            return power.reshape(-1, 3).sum(axis=1)
+        return power
+
+    def regions(self, activity, labeler):
+        '''
+        Share of the total activity in every region
+            labeler -- function of a position returning a tuple with the region name first, like identify_lobe
+        Returns list of (region, share, peak) sorted by share
+        '''
+        if self.labels is None:
+            names = [labeler(point)[0] for point in self.points]
+            (self.label_names, self.labels) = np.unique(names, return_inverse=True)
+        total = np.sum(activity)
+        shares = np.bincount(self.labels, weights=activity, minlength=len(self.label_names)) / total
+        peaks = np.zeros(len(self.label_names))
+        np.maximum.at(peaks, self.labels, activity)
+        order = np.argsort(shares)[::-1]
+        return [(self.label_names[i], shares[i], peaks[i]) for i in order]
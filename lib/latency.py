@@ -0,0 +1,96 @@
+"""
+
+Latency tracing of the acquisition to display pipeline
+
+    * Every window is traced from the read time of its newest report
+    * Stage durations go into histograms with logarithmic bins, so recording
+      is constant time and memory however long the session runs
+    * Percentiles are read from the bins, accurate to the bin width (~5%)
+
+"""
+
+import json
+import threading
+import numpy as np
+
+class Histogram:
+
+    def __init__(self, low=1e-5, high=100.0, bins_per_decade=48):
+        self.edges = np.logspace(np.log10(low), np.log10(high),
+                                 int(round(np.log10(high / low) * bins_per_decade)) + 1)
+        # First and last bin collect values outside [low, high)
+        self.counts = np.zeros(len(self.edges) + 1, dtype=np.int64)
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def add(self, value):
+        self.counts[np.searchsorted(self.edges, value, side='right')] += 1
+        self.count += 1
+        self.total += value
+        self.maximum = max(self.maximum, value)
+
+    def percentile(self, q):
+        '''
+        Upper edge of the bin holding the q-th percentile
+        '''
+        if self.count == 0:
+            return 0.0
+        index = np.searchsorted(np.cumsum(self.counts), q / 100.0 * self.count)
+        if index >= len(self.edges):
+            return self.maximum
+        return min(self.edges[index], self.maximum)
+
+    def stats(self):
+        return {'count': self.count,
+                'mean': self.total / self.count if self.count else 0.0,
+                'p50': self.percentile(50), 'p90': self.percentile(90),
+                'p99': self.percentile(99), 'max': self.maximum}
+
+class LatencyTracer:
+    '''
+    Histograms of the pipeline stages in seconds
+        acquire -- report read until its window is returned by the reader
+        filter -- streaming filter of the new rows of the window
+        ica -- covariance or online update and unmixing of the window
+        localize -- source positions of all components
+        handoff -- sources published until the first frame showing them is swapped
+        end_to_end -- report read until the frame showing its sources is swapped
+    '''
+
+    stages = ('acquire', 'filter', 'ica', 'localize', 'handoff', 'end_to_end')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = dict((stage, Histogram()) for stage in self.stages)
+
+    def record(self, stage, seconds):
+        with self.lock:
+            self.histograms[stage].add(seconds)
+
+    def stats(self):
+        with self.lock:
+            return dict((stage, self.histograms[stage].stats()) for stage in self.stages)
+
+    def summary(self):
+        lines = ['%-11s %7s %9s %9s %9s %9s %9s' % ('stage', 'count', 'mean ms', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms')]
+        stats = self.stats()
+        for stage in self.stages:
+            s = stats[stage]
+            lines.append('%-11s %7d %9.1f %9.1f %9.1f %9.1f %9.1f' % (stage, s['count'], 1000 * s['mean'], 1000 * s['p50'],
+                                                                   1000 * s['p90'], 1000 * s['p99'], 1000 * s['max']))
+        return '\n'.join(lines)
+
+    def dump(self, path=None):
+        '''
+        Print the summary, with a path also write stats and raw bins as JSON
+        '''
+        print self.summary()
+        if path is not None:
+            with self.lock:
+                data = dict((stage, dict(self.histograms[stage].stats(),
+                                         counts=self.histograms[stage].counts.tolist()))
+                            for stage in self.stages)
+                data['edges'] = self.histograms[self.stages[0]].edges.tolist()
+            with open(path, 'w') as f:
+                json.dump(data, f)
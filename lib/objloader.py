@@ -1,4 +1,3 @@
-import pygame
 import random
 from OpenGL.GL import *
 import numpy as np
@@ -16,6 +15,7 @@ def MTL(filename, path):
             raise ValueError, "mtl file doesn't start with newmtl stmt"
         elif values[0] == 'map_Kd':
             # load the texture referred to by this declaration
+            import pygame
             mtl[values[0]] = values[1]
             surf = pygame.image.load(mtl['map_Kd'])
             image = pygame.image.tostring(surf, 'RGBA', 1)
@@ -33,8 +33,10 @@ def MTL(filename, path):
     return contents
  
 class OBJ:
-    def __init__(self, filename, path, swapyz=False):
-        """Loads a Wavefront OBJ file. """
+    def __init__(self, filename, path, swapyz=False, compile=True):
+        """Loads a Wavefront OBJ file.
+        With compile=False only parses, call compile() later from the GL thread. """
+        self.gl_list = None
         self.vertices = []
         self.normals = []
         self.texcoords = []
@@ -81,6 +83,11 @@ class OBJ:
                         norms.append(0)
                 self.faces.append((face, norms, texcoords, material, self.colors))
 
+        if compile:
+            self.compile()
+
+    def compile(self):
+        """Builds the display list, needs current GL context. """
         self.gl_list = glGenLists(1)
         glNewList(self.gl_list, GL_COMPILE)
         glEnable(GL_TEXTURE_2D)
@@ -0,0 +1,116 @@
+"""
+
+Online ICA updated block by block as samples arrive
+
+    * Mean and covariance are tracked with an exponential forgetting factor,
+      the dominant principal components whiten the incoming samples
+    * Number of sources follows the variance ratio test of
+      SourceLocalizer.estimate_sources
+    * Rotation in the whitened space is updated by one natural gradient step
+      per block on the log cosh contrast, with the sign of every component
+      tracked so both sub- and super-Gaussian sources separate
+    * The unmixing is carried in sensor space, so it survives changes of the
+      whitening and of the number of sources
+
+"""
+
+import numpy as np
+
+def symmetric_decorrelation(W):
+    '''
+    Nearest orthonormal rows, (W W^T)^(-1/2) W
+    '''
+    (eigenvalues, eigenvectors) = np.linalg.eigh(np.dot(W, W.T))
+    return np.dot(np.dot(eigenvectors / np.sqrt(eigenvalues), eigenvectors.T), W)
+
+class OnlineICA:
+
+    # E[log cosh(v)] of a standard Gaussian v
+    gaussian_contrast = 0.3746
+
+    def __init__(self, channels, forgetting=0.995, learning_rate=0.1, threshold=0.1):
+        '''
+            channels -- number of columns of the samples
+            forgetting -- weight kept by the statistics per sample, 0.995 forgets with a time constant of 200 samples
+            learning_rate -- step of the natural gradient per block
+            threshold -- share of the variance a principal component needs to count as a source
+        '''
+        self.channels = channels
+        self.forgetting = forgetting
+        self.learning_rate = learning_rate
+        self.threshold = threshold
+        self.samples = 0
+        self.mean = np.zeros(channels)
+        self.covariance = np.zeros((channels, channels))
+        self.contrast = None
+        self.unmixing = None       # sources x channels
+        self.mixing_matrix = None  # channels x sources
+        self.number_of_sources = 0
+
+    def update(self, samples):
+        '''
+        Fold the next block of samples (time points x channels) into the decomposition
+        '''
+        samples = np.asarray(samples, dtype=float)
+        n = len(samples)
+        if n == 0:
+            return
+        self.track_statistics(samples)
+
+        # Whitening by the principal components that carry enough variance
+        (eigenvalues, eigenvectors) = np.linalg.eigh(self.covariance)
+        (eigenvalues, eigenvectors) = (eigenvalues[::-1], eigenvectors[:, ::-1])
+        count = max(list(eigenvalues / eigenvalues.sum() > self.threshold).count(True), 1)
+        whitening = (eigenvectors[:, :count] / np.sqrt(eigenvalues[:count])).T
+        white = np.dot(samples - self.mean, whitening.T)
+
+        W = self.rotation(whitening, count)
+        y = np.dot(white, W.T)
+
+        # Super-Gaussian components fall below the Gaussian contrast and are pushed further down,
+        # sub-Gaussian ones are pushed up
+        weight = 1.0 - self.forgetting ** n
+        contrast = np.log(np.cosh(y)).mean(axis=0) - self.gaussian_contrast
+        if self.contrast is None or len(self.contrast) != count:
+            self.contrast = contrast
+        else:
+            self.contrast += weight * (contrast - self.contrast)
+        signs = np.where(self.contrast < 0, -1.0, 1.0)
+
+        # Gradient ascent on the rotations, H - H^T keeps W orthonormal to first order
+        H = signs[:, np.newaxis] * np.dot(np.tanh(y).T, y) / n
+        W = symmetric_decorrelation(W + self.learning_rate * np.dot(H - H.T, W))
+
+        self.unmixing = np.dot(W, whitening)
+        self.mixing_matrix = np.linalg.pinv(self.unmixing)
+        self.number_of_sources = count
+
+    def track_statistics(self, samples):
+        n = len(samples)
+        block_mean = samples.mean(axis=0)
+        centered = samples - block_mean
+        block_covariance = np.dot(centered.T, centered) / n
+        if self.samples == 0:
+            (self.mean, self.covariance) = (block_mean, block_covariance)
+        else:
+            # Block weighs as much as its samples would under per-sample forgetting
+            weight = 1.0 - self.forgetting ** n
+            delta = block_mean - self.mean
+            self.mean = self.mean + weight * delta
+            self.covariance = ((1 - weight) * self.covariance + weight * block_covariance
+                               + weight * (1 - weight) * np.outer(delta, delta))
+        self.samples += n
+
+    def rotation(self, whitening, count):
+        '''
+        Previous unmixing expressed in the current whitened space
+        '''
+        if self.unmixing is None:
+            return np.eye(count)
+        W = np.dot(self.unmixing, np.linalg.pinv(whitening))
+        if len(W) == count:
+            return symmetric_decorrelation(W)
+        # Components that keep most energy in the new subspace come first, the rest is completed
+        W = W[np.argsort(-np.sum(W ** 2, axis=1))]
+        (Q, R) = np.linalg.qr(np.vstack((W, np.eye(count))).T)
+        return Q.T[:count]
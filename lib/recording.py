@@ -0,0 +1,196 @@
+"""
+
+Binary recording format for EEG sessions
+
+    * Fixed size header: magic string followed by JSON with channel names,
+      sample rate, electrode montage, column names and sample dtype
+    * Sample block: rows of `columns` values stored as `dtype`, appended
+      until the end of the file
+    * Opened with np.memmap, so only the pages that are read get loaded
+
+"""
+
+import json
+import os
+import threading
+import Queue
+import numpy as np
+from lib.cache import replace_file
+
+MAGIC = 'BA3DREC1'
+HEADER_SIZE = 4096
+
+def write_header(f, channels, sample_rate, montage, columns=None, dtype='<f4'):
+    header = json.dumps({'channels': list(channels),
+                         'sample_rate': sample_rate,
+                         'montage': [list(map(float, position)) for position in montage],
+                         'columns': list(columns or channels),
+                         'dtype': np.dtype(dtype).str})
+    if len(MAGIC) + len(header) > HEADER_SIZE:
+        raise ValueError('Recording header does not fit into %d bytes' % HEADER_SIZE)
+    f.write(MAGIC + header.ljust(HEADER_SIZE - len(MAGIC)))
+
+def read_header(f):
+    block = f.read(HEADER_SIZE)
+    if not block.startswith(MAGIC):
+        raise ValueError('%s is not a recording file' % f.name)
+    return json.loads(block[len(MAGIC):])
+
+class Recording:
+    '''
+    Read-only view of a recording file
+        samples -- (time points x channels) memory-mapped array
+        data -- all columns, including any extra per-sample columns
+    '''
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            header = read_header(f)
+        self.path = path
+        self.channels = header['channels']
+        self.sample_rate = header['sample_rate']
+        self.montage = np.asarray(header['montage'])
+        self.columns = header['columns']
+        self.dtype = np.dtype(header['dtype'])
+
+        # Number of rows follows from the file size, trailing partial row is ignored
+        row_size = self.dtype.itemsize * len(self.columns)
+        rows = (os.path.getsize(path) - HEADER_SIZE) // row_size
+        if rows > 0:
+            self.data = np.memmap(path, dtype=self.dtype, mode='r', offset=HEADER_SIZE,
+                                  shape=(rows, len(self.columns)))
+        else:
+            self.data = np.zeros((0, len(self.columns)), dtype=self.dtype)
+        self.samples = self.data[:, :len(self.channels)]
+
+    def __len__(self):
+        return len(self.data)
+
+    def column(self, name):
+        return self.data[:, self.columns.index(name)]
+
+class RecordingWriter:
+    '''
+    Append-only writer of the recording format
+    '''
+
+    def __init__(self, path, channels, sample_rate, montage, columns=None, dtype='<f4'):
+        self.dtype = np.dtype(dtype)
+        self.columns = list(columns or channels)
+        self.f = open(path, 'wb')
+        write_header(self.f, channels, sample_rate, montage, self.columns, self.dtype)
+
+    def append(self, rows):
+        self.f.write(np.asarray(rows, dtype=self.dtype).reshape(-1, len(self.columns)).tostring())
+
+    def close(self):
+        self.f.close()
+
+class SessionRecorder:
+    '''
+    Streaming recorder for acquisition sessions
+    Rows are gathered into preallocated chunks that a background thread appends
+    to disk, when all chunks are in flight new rows are dropped and counted
+    instead of blocking the caller
+    '''
+
+    extra_columns = ['COUNTER', 'QUALITY_SENSOR', 'QUALITY', 'TIMESTAMP']
+
+    def __init__(self, path, channels, sample_rate, montage, chunk_size=1024, chunks=8):
+        self.channels = len(channels)
+        self.writer = RecordingWriter(path, channels, sample_rate, montage,
+                                      list(channels) + self.extra_columns, '<f8')
+        self.free = Queue.Queue()
+        self.pending = Queue.Queue()
+        for i in range(chunks):
+            self.free.put(np.empty((chunk_size, self.channels + len(self.extra_columns))))
+        self.chunk = self.free.get()
+        self.filled = 0
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, samples, counters, quality_sensors, quality, timestamps):
+        '''
+        Append a block of rows, never blocks
+        '''
+        done = 0
+        while done < len(samples):
+            if self.chunk is None:
+                try:
+                    self.chunk = self.free.get_nowait()
+                except Queue.Empty:
+                    self.dropped += len(samples) - done
+                    return
+            n = min(len(samples) - done, len(self.chunk) - self.filled)
+            rows = self.chunk[self.filled:self.filled + n]
+            rows[:, :self.channels] = samples[done:done + n]
+            rows[:, self.channels] = counters[done:done + n]
+            rows[:, self.channels + 1] = quality_sensors[done:done + n]
+            rows[:, self.channels + 2] = quality[done:done + n]
+            rows[:, self.channels + 3] = timestamps[done:done + n]
+            self.filled += n
+            done += n
+            if self.filled == len(self.chunk):
+                self.flush()
+
+    def flush(self):
+        if self.chunk is not None and self.filled > 0:
+            self.pending.put((self.chunk, self.filled))
+            self.chunk = None
+            self.filled = 0
+
+    def run(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                break
+            (chunk, filled) = item
+            self.writer.append(chunk[:filled])
+            self.free.put(chunk)
+        self.writer.close()
+
+    def close(self):
+        self.flush()
+        self.pending.put(None)
+        self.thread.join()
+
+def convert_csv(csv_path, path, channels, montage, sample_rate=128, dtype='<f4', chunk=4096):
+    '''
+    Import a CSV recording, first len(channels) columns are the samples
+    '''
+    writer = RecordingWriter(path, channels, sample_rate, montage, dtype=dtype)
+    try:
+        lines = []
+        for line in open(csv_path):
+            lines.append(line)
+            if len(lines) == chunk:
+                writer.append(np.loadtxt(lines, delimiter=',', usecols=range(len(channels)), ndmin=2))
+                lines = []
+        if lines:
+            writer.append(np.loadtxt(lines, delimiter=',', usecols=range(len(channels)), ndmin=2))
+    finally:
+        writer.close()
+
+def open_recording(path, channels, montage):
+    '''
+    Open a recording, CSV files are converted once and cached next to the original
+    '''
+    if path.endswith('.csv'):
+        csv_path, path = path, os.path.splitext(path)[0] + '.rec'
+        if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(csv_path):
+            convert_csv(csv_path, path + '.part', channels, montage)
+            replace_file(path + '.part', path)
+    return Recording(path)
+
+if __name__ == '__main__':
+    import sys
+    from lib.epoc import Epoc
+    if len(sys.argv) < 2:
+        print 'Usage: python -m lib.recording recording.csv [recording.rec]'
+        sys.exit(1)
+    csv_path = sys.argv[1]
+    path = sys.argv[2] if len(sys.argv) > 2 else os.path.splitext(csv_path)[0] + '.rec'
+    convert_csv(csv_path, path, [c[1] for c in Epoc.coordinates], [c[0] for c in Epoc.coordinates])
+    print 'Wrote %d samples to %s' % (len(Recording(path)), path)
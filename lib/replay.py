@@ -0,0 +1,94 @@
+"""
+
+Replay of recorded sessions in place of the live headset
+
+    * Feeds recording rows into the same RingBuffer the reader process fills
+    * Paced at the recording sample rate, N times faster, or as fast as the
+      consumer keeps up with
+
+"""
+
+from lib.ringbuffer import clock
+import numpy as np
+import time
+from threading import Thread
+
+class Replay:
+
+    recording = None
+    buffer = None
+    speed = 1.0
+    loop = True
+    position = 0
+    running = False
+    thread = None
+
+    def __init__(self, recording, buffer, speed=1.0, loop=True, chunk=16):
+        '''
+            recording -- lib.recording.Recording to play
+            buffer -- RingBuffer to write samples into
+            speed -- 1.0 for real time, N for N times faster, None for as fast as possible
+            loop -- start over at the end of the recording
+        '''
+        self.recording = recording
+        self.buffer = buffer
+        self.speed = speed
+        self.loop = loop
+        self.chunk = chunk
+        if 'COUNTER' in recording.columns:
+            self.counters = recording.column('COUNTER')
+        else:
+            self.counters = np.arange(len(recording)) % 129
+        self.seek(0)
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.seek(self.position)
+        self.thread = Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def seek(self, position):
+        '''
+        Continue playback from the given sample
+        '''
+        self.position = position
+        self.origin_position = position
+        self.origin_time = clock()
+
+    def due(self):
+        '''
+        Number of samples that should have been emitted by now
+        '''
+        if self.speed is None:
+            # Never overwrite rows the consumer still uses
+            free = self.buffer.consumed.value + self.buffer.capacity - self.buffer.count()
+            return min(free, self.chunk * 8)
+        elapsed = clock() - self.origin_time
+        return int(self.origin_position + elapsed * self.recording.sample_rate * self.speed) - self.position
+
+    def run(self):
+        while self.running:
+            if self.position >= len(self.recording):
+                if not self.loop:
+                    self.running = False
+                    break
+                self.seek(0)
+            n = min(self.due(), len(self.recording) - self.position)
+            if n <= 0:
+                if self.speed is None:
+                    time.sleep(0.001)
+                else:
+                    time.sleep(1.0 / (self.recording.sample_rate * self.speed))
+                continue
+            rows = slice(self.position, self.position + n)
+            self.buffer.write(self.recording.samples[rows], self.counters[rows], np.repeat(clock(), n))
+            self.position += n
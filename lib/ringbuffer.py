@@ -0,0 +1,150 @@
+"""
+
+Lock-free single producer / single consumer ring buffer in shared memory
+
+    * Rows hold one sample of every channel plus packet counter and timestamp
+    * Every row is stored twice, so any window up to the capacity is contiguous
+    * Producer publishes rows by advancing a shared write counter, consumer
+      reports rows it no longer needs by advancing a shared release counter
+    * When the consumer falls a whole buffer behind, the overflow policy either
+      overwrites the oldest rows, discards the newest ones or blocks the producer
+    * Closing the buffer wakes both sides, so neither waits on a peer that stopped
+
+"""
+
+import numpy as np
+import time
+from multiprocessing import RawArray, RawValue
+
+# Monotonic where available, timestamps are compared across processes
+clock = getattr(time, 'monotonic', time.time)
+
+class RingBuffer:
+
+    capacity = 0
+    channels = 0
+    policy = 'drop-oldest'
+    policies = ('drop-oldest', 'drop-newest', 'block')
+
+    def __init__(self, capacity, channels, policy='drop-oldest'):
+        if policy not in self.policies:
+            raise ValueError('Unknown buffer policy %s' % policy)
+        self.capacity = capacity
+        self.channels = channels
+        self.policy = policy
+        self.shared = RawArray('d', 2 * capacity * (channels + 2))
+        self.written = RawValue('L', 0)
+        self.consumed = RawValue('L', 0)
+        self.dropped = RawValue('L', 0)
+        self.high_water = RawValue('L', 0)
+        self.closed = RawValue('b', False)
+        self.attach()
+
+    def attach(self):
+        '''
+        Map NumPy views onto the shared block
+        '''
+        rows = 2 * self.capacity
+        block = np.frombuffer(self.shared, dtype=np.float64)
+        self.samples = block[:rows * self.channels].reshape(rows, self.channels)
+        self.counters = block[rows * self.channels:rows * (self.channels + 1)]
+        self.timestamps = block[rows * (self.channels + 1):]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for view in ('samples', 'counters', 'timestamps'):
+            del state[view]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.attach()
+
+    def count(self):
+        '''
+        Total number of rows written so far
+        '''
+        return self.written.value
+
+    def room(self):
+        '''
+        Number of rows that can be written without overwriting unreleased ones
+        '''
+        return self.consumed.value + self.capacity - self.written.value
+
+    def write(self, samples, counters, timestamps):
+        '''
+        Append rows, called only from the producer process
+        '''
+        if self.policy == 'block':
+            # Hand rows over piece by piece as the consumer releases room
+            done = 0
+            while done < len(samples):
+                room = self.room()
+                if room <= 0:
+                    if self.closed.value:
+                        return
+                    time.sleep(1.0 / 128)
+                    continue
+                self.store(samples[done:done + room], counters[done:done + room], timestamps[done:done + room])
+                done += room
+            return
+
+        room = max(self.room(), 0)
+        if len(samples) > room:
+            self.dropped.value += len(samples) - room
+            if self.policy == 'drop-newest':
+                samples, counters, timestamps = samples[:room], counters[:room], timestamps[:room]
+        self.store(samples, counters, timestamps)
+
+    def store(self, samples, counters, timestamps):
+        # Of more than a whole buffer only the last rows survive
+        end = self.written.value + len(samples)
+        samples = np.asarray(samples)[-self.capacity:]
+        counters = np.asarray(counters)[-self.capacity:]
+        timestamps = np.asarray(timestamps)[-self.capacity:]
+        index = (end - len(samples) + np.arange(len(samples))) % self.capacity
+        for mirror in (index, index + self.capacity):
+            self.samples[mirror] = samples
+            self.counters[mirror] = counters
+            self.timestamps[mirror] = timestamps
+        self.written.value = end
+        self.high_water.value = max(self.high_water.value, self.written.value - self.consumed.value)
+
+    def stats(self):
+        return {'size': self.written.value - self.consumed.value, 'capacity': self.capacity,
+                'high_water': self.high_water.value, 'dropped': self.dropped.value}
+
+    def window(self, end, size):
+        '''
+        Zero-copy view of rows [end - size, end) as (samples, counters, timestamps)
+        Rows stay valid until the producer writes another `capacity - size` rows
+        '''
+        start = (end - size) % self.capacity
+        return (self.samples[start:start + size],
+                self.counters[start:start + size],
+                self.timestamps[start:start + size])
+
+    def release(self, count):
+        '''
+        Mark rows before `count` as no longer used, called only from the consumer
+        '''
+        self.consumed.value = max(self.consumed.value, count)
+
+    def close(self):
+        '''
+        Wake up and stop waiting readers and blocked writers
+        '''
+        self.closed.value = True
+
+    def wait(self, count, timeout=None, period=1.0 / 128):
+        '''
+        Block until at least `count` rows have been written
+        Returns the number of rows written, fewer than `count` if the buffer was closed or the timeout passed
+        '''
+        deadline = None if timeout is None else clock() + timeout
+        while self.written.value < count and not self.closed.value:
+            if deadline is not None and clock() >= deadline:
+                break
+            time.sleep(period)
+        return self.written.value
@@ -1,77 +1,489 @@
 """
 
 Implementation of Source Localization
-    * Estimate electrode contributions using ica
+    * Estimate electrode contributions using ica, batch FastICA on every window
+      or online ICA updated with the new samples only
     * Optimize for (x, y, z, k), where k is coefficient to convert ICA's output to the distance
+    * Contributions follow the heuristic k / (d^2 + 1) or a dipole in a multi-shell
+      spherical head, lib.forward.SphericalHead, where k is the length of the moment
 
 """
 
-from sklearn.decomposition import FastICA
-from scipy.optimize import minimize
-from sklearn.decomposition import PCA
+import numpy as np
 import operator
 import time
 import random
+import warnings
 
 class SourceLocalizer:
 
     data = None
     epoc = None
     mixing_matrix = None
-    electrode_data = []
+    # Electrode positions (electrodes x 3) and contributions of the source being fitted
+    electrode_positions = None
+    contributions = None
+    # Weight of the penalty on the distance between source and electrodes
+    alpha = 0.3
     number_of_sources = None
     last_source_locations = {}
+    # Unmixing of the previous window (sources x electrodes), starting point of the next ICA
+    unmixing = None
+    ica_max_iter = 200
+    # A warm start that needs more iterations than this is abandoned for a cold one
+    ica_warm_iter = 20
+    ica_iterations = 0
+    ica_time = 0
+    ica_warm = False
+    ica_cold_starts = 0
+    engine = 'fastica'
+    engines = ('fastica', 'online')
+    online = None
+    # Window covariance and its eigendecomposition, shared by estimate_sources and ica
+    covariance = None
+    eigenvalues = None
+    eigenvectors = None
+    # Persistent id of every column of mixing_matrix, see match_components
+    component_ids = None
+    previous_patterns = None
+    next_component_id = 0
+    # Least similarity of spatial patterns for a component to continue a previous one
+    match_threshold = 0.5
+    # Iterations, function evaluations and convergence of the last optimize
+    optimizer_iterations = 0
+    optimizer_evaluations = 0
+    optimizer_converged = False
+    solver = 'least-squares'
+    solvers = ('least-squares', 'nelder-mead', 'grid')
+    # Solve k in closed form and search over the position only
+    projection = True
+    # lib.forward.SourceGrid of the grid solver, built on first use
+    grid = None
+    refine = True
+    forward = 'heuristic'
+    forwards = ('heuristic', 'sphere')
+    # lib.forward.SphericalHead of the spherical forward model, built on first use
+    head = None
 
-    def __init__(self, epoc):
+    def __init__(self, epoc, engine='fastica', solver='least-squares', projection=True, refine=True, forward='heuristic'):
+        '''
+            engine -- 'fastica' to decompose every window, 'online' to update lib.onlineica.OnlineICA
+            solver -- 'least-squares' for Levenberg-Marquardt with analytic Jacobian, 'nelder-mead' for the simplex search,
+                      'grid' for the best point of a precomputed grid inside the brain
+            projection -- eliminate k in closed form, so the solver searches (x, y, z) only
+            refine -- continue from the grid point with least squares
+            forward -- 'heuristic' contribution model or 'sphere' for the multi-shell spherical head,
+                       which fits with the batched least squares or the grid only
+        '''
+        if engine not in self.engines:
+            raise ValueError('Unknown ICA engine %s' % engine)
+        if solver not in self.solvers:
+            raise ValueError('Unknown solver %s' % solver)
+        if forward not in self.forwards:
+            raise ValueError('Unknown forward model %s' % forward)
+        if forward == 'sphere' and (solver == 'nelder-mead' or not projection):
+            raise ValueError('The spherical head needs the least-squares or grid solver with projection')
         self.epoc = epoc
+        self.engine = engine
+        self.solver = solver
+        self.projection = projection
+        self.refine = refine
+        self.forward = forward
+        self.last_source_locations = {}
 
-    def set_data(self, data):
+    def set_data(self, data, new_samples=None):
+        '''
+        new_samples -- number of rows at the end of data not seen before, all rows if None
+        '''
         self.data = data
-        self.number_of_sources = self.estimate_sources();
+        if self.engine == 'online':
+            from lib.onlineica import OnlineICA
+            if self.online is None:
+                self.online = OnlineICA(data.shape[1])
+            start = time.time()
+            self.online.update(data if new_samples is None else data[len(data) - new_samples:])
+            self.ica_time = time.time() - start
+            self.ica_iterations = 1
+            self.ica_warm = True
+            self.number_of_sources = self.online.number_of_sources
+        else:
+            from lib.covariance import SlidingCovariance
+            if self.covariance is None:
+                self.covariance = SlidingCovariance()
+            self.covariance.update(data, new_samples)
+            (self.eigenvalues, self.eigenvectors) = self.covariance.eigen()
+            self.number_of_sources = self.estimate_sources();
+
+    def warm_up(self, samples, electrodes):
+        '''
+        Load the estimators and run them once, so the first real window is not delayed
+        Three non-Gaussian sources through a fixed mixing always give a number of sources to separate,
+        white noise may leave none
+        '''
+        t = np.arange(samples) / 128.0
+        sources = np.array([np.sin(2 * np.pi * 10 * t), np.sign(np.sin(2 * np.pi * 6 * t)), (3 * t) % 1 - 0.5])
+        mixing = np.cos(np.outer(np.arange(1, electrodes + 1), [0.7, 1.9, 3.1]))
+        self.set_data(np.dot(mixing, sources).T)
+        self.ica()
 
     def ica(self):
         '''
         Perform ICA on the data
             source_matrix -- rows are sources, columns are time points, values are ?
             mixing_matrix -- rows are electrodes, columns are source, values are contributions of the electrode to the source
+        Consecutive windows overlap, so the unmixing of the previous window is the
+        initial guess, cold start when the number of sources changed or it did not converge
+        Iterations and wall time of the last run are kept in ica_iterations and ica_time
+        The online engine has already been updated by set_data
+        '''
+        if self.engine == 'online':
+            self.unmixing = self.online.unmixing
+            self.mixing_matrix = self.online.mixing_matrix
+            self.match_components()
+            return
+
+        from sklearn.decomposition import FastICA
+        from sklearn.exceptions import ConvergenceWarning
+        start = time.time()
+        n = self.number_of_sources
+
+        # Same whitening FastICA would do, from the eigendecomposition of set_data, so the
+        # previous unmixing can be mapped into it
+        N = len(self.data)
+        whitening = (self.eigenvectors[:, :n] / np.sqrt(N * self.eigenvalues[:n])).T
+        white = np.dot(self.data - self.covariance.mean(), whitening.T) * np.sqrt(N)
+
+        iterations = 0
+        w_init = None
+        if self.unmixing is not None and len(self.unmixing) == n:
+            w_init = np.dot(self.unmixing, np.linalg.pinv(whitening))
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', ConvergenceWarning)
+                ica = FastICA(whiten=False, w_init=w_init, max_iter=self.ica_warm_iter)
+                ica.fit(white)
+            iterations = ica.n_iter_
+            if iterations >= self.ica_warm_iter:
+                w_init = None
+        if w_init is None:
+            ica = FastICA(whiten=False, max_iter=self.ica_max_iter)
+            ica.fit(white)
+            iterations += ica.n_iter_
+            self.ica_cold_starts += 1
+
+        self.unmixing = np.dot(ica.components_, whitening)
+        self.mixing_matrix = np.linalg.pinv(self.unmixing)  # estimated mixing matrix
+        self.match_components()
+        self.ica_warm = w_init is not None
+        self.ica_iterations = iterations
+        self.ica_time = time.time() - start
+
+    def match_components(self):
+        '''
+        ICA returns components in arbitrary order and sign, align the columns of
+        mixing_matrix to the previous window by the similarity of their spatial patterns
+        Matched components keep id, relative order and sign, the others get new ids
         '''
-        ica = FastICA(self.number_of_sources)
-        ica.fit(self.data)
-        self.mixing_matrix = ica.mixing_  # estimated mixing matrix
+        from scipy.optimize import linear_sum_assignment
+        patterns = self.mixing_matrix / np.linalg.norm(self.mixing_matrix, axis=0)
+        n = patterns.shape[1]
+        order = []
+        ids = []
+        signs = np.ones(n)
+        if self.previous_patterns is not None:
+            similarity = np.dot(self.previous_patterns.T, patterns)
+            (previous, current) = linear_sum_assignment(-np.abs(similarity))
+            for (p, c) in sorted(zip(previous, current)):
+                if abs(similarity[p, c]) >= self.match_threshold:
+                    order.append(c)
+                    ids.append(self.component_ids[p])
+                    signs[c] = np.sign(similarity[p, c])
+        for c in range(n):
+            if c not in order:
+                order.append(c)
+                ids.append(self.next_component_id)
+                self.next_component_id += 1
+        signs = signs[order]
+        self.mixing_matrix = self.mixing_matrix[:, order] * signs
+        self.unmixing = self.unmixing[order] * signs[:, np.newaxis]
+        self.previous_patterns = patterns[:, order] * signs
+        self.component_ids = ids
+        # Locations of components that are gone would never be used again
+        for key in self.last_source_locations.keys():
+            if key not in ids:
+                del self.last_source_locations[key]
 
     def optimize(self, source):
         '''
         Input:
-            source - integer, id of the source
+            source - integer, column of the source in mixing_matrix
         Return
             (x, y, z, k)
+        With projection the search is over (x, y, z) only and k is solved for each position
         '''
-        self.electrode_data = []
-        for i,coordinate in enumerate(self.epoc.coordinates):
-            self.electrode_data.append({'position':coordinate[0], 'contribution': self.mixing_matrix[i][source]}) 
+        self.electrode_positions = np.array([coordinate[0] for coordinate in self.epoc.coordinates], dtype=float)
+        self.contributions = self.mixing_matrix[:, source]
+        start = self.last_source_locations.get(self.component_ids[source], [0, 0, 0, 1])
+        if self.solver == 'grid':
+            (positions, amplitudes, errors) = self.source_grid().locate(self.contributions[:, np.newaxis])
+            start = list(positions[0]) + [amplitudes[0]]
+            # A grid point is not a converged fit, only its refinement is
+            (self.optimizer_iterations, self.optimizer_evaluations, self.optimizer_converged) = (0, len(self.source_grid()), False)
+            if not self.refine:
+                return np.array(start)
+        if self.forward == 'sphere':
+            (positions, amplitudes, info) = self.batch_fit(np.array([start[0:3]], dtype=float), self.contributions[np.newaxis])
+            (self.optimizer_iterations, self.optimizer_evaluations, self.optimizer_converged) = (
+                info['iterations'][0], info['evaluations'][0], info['converged'][0])
+            return np.append(positions[0], amplitudes[0])
 
-        result = minimize(self.error, self.last_source_locations.get(source, [0, 0, 0, 1]), method='Nelder-Mead')     
+        if self.projection:
+            (residuals, jacobian, error, start) = (self.projected_residuals, self.projected_jacobian,
+                                                   self.projected_error, start[0:3])
+        else:
+            (residuals, jacobian, error) = (self.residuals, self.jacobian, self.error)
+        if self.solver in ('least-squares', 'grid'):
+            from scipy.optimize import least_squares
+            result = least_squares(residuals, start, jac=jacobian, method='lm', x_scale='jac')
+            # Levenberg-Marquardt evaluates the Jacobian once per iteration
+            self.optimizer_iterations = result.njev
+        else:
+            from scipy.optimize import minimize
+            result = minimize(error, start, method='Nelder-Mead')     
+            self.optimizer_iterations = result.nit
+        self.optimizer_evaluations = result.nfev
+        self.optimizer_converged = result.success
+        if self.projection:
+            return np.append(result.x, self.amplitude(result.x))
         return result.x
 
+    def source_grid(self):
+        if self.grid is None:
+            from lib.forward import SourceGrid
+            head = self.spherical_head() if self.forward == 'sphere' else None
+            self.grid = SourceGrid(self.electrode_positions, alpha=self.alpha, head=head)
+        return self.grid
+
+    def spherical_head(self):
+        if self.head is None:
+            from lib.forward import SphericalHead
+            self.head = SphericalHead(self.electrode_positions)
+        return self.head
+
+    def amplitude(self, source_pos):
+        '''
+        k of the least contribution misfit at a given position, the model is linear in k
+        '''
+        g = self.contribution_estimate(source_pos, self.electrode_positions, 1.0)
+        return np.dot(g, self.contributions) / np.dot(g, g)
+
+    def projected_residuals(self, source_pos):
+        return self.residuals(np.append(source_pos, self.amplitude(source_pos)))
+
+    def projected_error(self, source_pos):
+        return np.sum(self.projected_residuals(source_pos)**2)
+
+    def projected_jacobian(self, source_pos):
+        '''
+        Derivatives of projected_residuals by (x, y, z), including the change of the optimal k
+        '''
+        difference = source_pos - self.electrode_positions
+        g = 1.0 / (np.sum(difference**2, axis=1) + 1)
+        gg = np.dot(g, g)
+        k = np.dot(g, self.contributions) / gg
+        dg = (-2 * g**2)[:, np.newaxis] * difference
+        dk = (np.dot(self.contributions, dg) - 2 * k * np.dot(g, dg)) / gg
+        J = self.jacobian(np.append(source_pos, k))[:, :3]
+        J[:len(g)] = -(k * dg + np.outer(g, dk))
+        return J
+
     def error(self, configuration):
         source_pos = configuration[0:3]
         k = configuration[3]
-        alpha = 0.3
-        s = 0
-        for electrode in self.electrode_data:
-            s += (electrode['contribution'] - self.contribution_estimate(source_pos, electrode['position'], k))**2 + alpha*(sum((source_pos - electrode['position'])**2) + 1)
-        return s
+        distances = np.sum((source_pos - self.electrode_positions)**2, axis=1)
+        return np.sum((self.contributions - self.contribution_estimate(source_pos, self.electrode_positions, k))**2
+                      + self.alpha*(distances + 1))
+
+    def residuals(self, configuration):
+        '''
+        Terms of error as a vector whose sum of squares is the error
+            contribution misfit of every electrode, then sqrt of the distance penalty of every electrode
+        '''
+        distances = np.sum((configuration[0:3] - self.electrode_positions)**2, axis=1)
+        return np.concatenate((self.contributions - configuration[3] / (distances + 1),
+                               np.sqrt(self.alpha * (distances + 1))))
+
+    def jacobian(self, configuration):
+        '''
+        Derivatives of residuals by (x, y, z, k)
+        '''
+        difference = configuration[0:3] - self.electrode_positions
+        distances = np.sum(difference**2, axis=1)
+        g = 1.0 / (distances + 1)
+        penalty = np.sqrt(self.alpha * (distances + 1))
+        J = np.zeros((2 * len(difference), 4))
+        J[:len(difference), :3] = (2 * configuration[3] * g**2)[:, np.newaxis] * difference
+        J[:len(difference), 3] = -g
+        J[len(difference):, :3] = (self.alpha / penalty)[:, np.newaxis] * difference
+        return J
 
     def contribution_estimate(self, source_pos, electrode_pos, k):
-        return k / (sum((source_pos - electrode_pos)**2) + 1)
+        return k / (np.sum((source_pos - electrode_pos)**2, axis=-1) + 1)
 
     def localize(self, source):   
         (x, y, z, k) = self.optimize(source)
-        self.last_source_locations[source] = [x, y, z, k]
+        self.last_source_locations[self.component_ids[source]] = [x, y, z, k]
         return [x, y, z]
 
+    def localize_all(self):
+        '''
+        Fit every column of mixing_matrix at once
+        Return
+            ([[x, y, z] for every source], info)
+            info -- dict of per source arrays 'iterations', 'evaluations' of the model, 'converged' and 'error'
+        The Nelder-Mead solver and the 4-D search fit the sources one by one
+        The grid solver without refine takes no iterations, evaluates every grid point and does not converge
+        '''
+        n = self.mixing_matrix.shape[1]
+        if self.solver == 'nelder-mead' or not self.projection:
+            (locations, iterations, evaluations, converged) = ([], [], [], [])
+            for source in range(n):
+                locations.append(self.localize(source))
+                iterations.append(self.optimizer_iterations)
+                evaluations.append(self.optimizer_evaluations)
+                converged.append(self.optimizer_converged)
+            configurations = [np.array(self.last_source_locations[i]) for i in self.component_ids]
+            return locations, {'iterations': np.array(iterations, dtype=int),
+                               'evaluations': np.array(evaluations, dtype=int),
+                               'converged': np.array(converged, dtype=bool),
+                               'error': np.array([self.error(c) for c in configurations])}
+
+        self.electrode_positions = np.array([coordinate[0] for coordinate in self.epoc.coordinates], dtype=float)
+        contributions = self.mixing_matrix.T
+        if self.solver == 'grid':
+            (positions, amplitudes, errors) = self.source_grid().locate(self.mixing_matrix)
+            info = {'iterations': np.zeros(n, dtype=int), 'evaluations': np.repeat(len(self.source_grid()), n),
+                    'converged': np.zeros(n, dtype=bool), 'error': errors}
+        else:
+            positions = np.array([self.last_source_locations.get(i, [0, 0, 0, 1])[0:3] for i in self.component_ids], dtype=float)
+        if self.solver != 'grid' or self.refine:
+            (positions, amplitudes, info) = self.batch_fit(positions, contributions)
+        for (i, position, k) in zip(self.component_ids, positions, amplitudes):
+            self.last_source_locations[i] = list(position) + [k]
+        return [list(position) for position in positions], info
+
+    def batch_model(self, positions, contributions):
+        '''
+        Projected residuals of all sources (sources x 2 electrodes), their Jacobian
+        (sources x 2 electrodes x 3, see projected_jacobian) and the optimal k of every source
+        The spherical head has no distance penalty, see sphere_model
+        '''
+        if self.forward == 'sphere':
+            return self.sphere_model(positions, contributions)
+        difference = positions[:, np.newaxis, :] - self.electrode_positions[np.newaxis, :, :]
+        distances = np.sum(difference**2, axis=2)
+        g = 1.0 / (distances + 1)
+        gg = np.sum(g**2, axis=1)
+        k = np.sum(g * contributions, axis=1) / gg
+        penalty = np.sqrt(self.alpha * (distances + 1))
+        residuals = np.concatenate((contributions - k[:, np.newaxis] * g, penalty), axis=1)
+
+        dg = (-2 * g**2)[:, :, np.newaxis] * difference
+        dk = (np.einsum('se,sej->sj', contributions, dg) - 2 * k[:, np.newaxis] * np.einsum('se,sej->sj', g, dg)) / gg[:, np.newaxis]
+        J = np.concatenate((-(k[:, np.newaxis, np.newaxis] * dg + g[:, :, np.newaxis] * dk[:, np.newaxis, :]),
+                            (self.alpha / penalty)[:, :, np.newaxis] * difference), axis=1)
+        return residuals, J, k
+
+    def sphere_model(self, positions, contributions):
+        '''
+        batch_model of the spherical head, residuals at the best moment of every source (sources x electrodes),
+        their Jacobian and the length of the moments
+        The moment is eliminated like k, the Jacobian of the projected residuals r = c - L L^+ c is
+        -(I - L L^+) dL L^+ c - (L^+)^T dL^T r (Golub and Pereyra)
+        '''
+        (L, dL) = self.spherical_head().lead_field(positions, gradient=True)
+        # L^+ = (L^T L)^-1 L^T of every source (sources x 3 x electrodes)
+        pseudo_inverse = np.linalg.solve(np.einsum('sei,sej->sij', L, L), L.transpose(0, 2, 1))
+        moments = np.einsum('sie,se->si', pseudo_inverse, contributions)
+        residuals = contributions - np.einsum('sei,si->se', L, moments)
+        # dL m and dL^T r for every coordinate (sources x electrodes x 3 and sources x 3 x 3)
+        change = np.einsum('seij,si->sej', dL, moments)
+        back = np.einsum('seij,se->sij', dL, residuals)
+        J = -(change - np.einsum('sei,sij->sej', L, np.einsum('sie,sej->sij', pseudo_inverse, change))
+              + np.einsum('sie,sij->sej', pseudo_inverse, back))
+
+        # A source on the shell that would descend outward can only move along it, without the radial
+        # direction the steps no longer end up clamped and the fit converges in a few iterations
+        head = self.spherical_head()
+        offsets = positions - head.center
+        radial = offsets / np.maximum(np.sqrt(np.sum(offsets**2, axis=1)), 1e-12)[:, np.newaxis]
+        outward = np.einsum('sej,se,sj->s', J, residuals, radial) < 0
+        blocked = outward & (np.sum(offsets**2, axis=1) >= (head.limit * (1 - 1e-9))**2)
+        if np.any(blocked):
+            J[blocked] -= np.einsum('sej,sj->se', J[blocked], radial[blocked])[:, :, np.newaxis] * radial[blocked][:, np.newaxis, :]
+        return residuals, J, np.sqrt(np.sum(moments**2, axis=1))
+
+    def constrain(self, positions):
+        '''
+        Positions the forward model can evaluate, inside the innermost shell of the spherical head
+        '''
+        if self.forward == 'sphere':
+            return self.spherical_head().clamp(positions)
+        return positions
+
+    def batch_fit(self, positions, contributions, max_iter=100, tolerance=1e-8):
+        '''
+        Levenberg-Marquardt on all sources together, every source keeps its own damping
+        and stops on its own, each iteration is one array operation over all sources
+        '''
+        n = len(positions)
+        positions = self.constrain(positions)
+        (residuals, J, amplitudes) = self.batch_model(positions, contributions)
+        cost = np.sum(residuals**2, axis=1)
+        damping = np.repeat(1e-3, n)
+        growth = np.repeat(2.0, n)
+        iterations = np.zeros(n, dtype=int)
+        converged = np.zeros(n, dtype=bool)
+        for i in range(max_iter):
+            index = np.flatnonzero(~converged)
+            if len(index) == 0:
+                break
+            JTJ = np.einsum('sei,sej->sij', J[index], J[index])
+            gradient = np.einsum('sei,se->si', J[index], residuals[index])
+            # Marquardt scaling by the diagonal, as least_squares(x_scale='jac')
+            scaled = damping[index, np.newaxis] * np.einsum('sii->si', JTJ)
+            step = -np.linalg.solve(JTJ + scaled[:, :, np.newaxis] * np.eye(3), gradient[:, :, np.newaxis])[:, :, 0]
+            trial = self.constrain(positions[index] + step)
+            # A step beyond the shell ends on it, convergence looks at the step actually taken
+            taken = trial - positions[index]
+            (trial_residuals, trial_J, trial_amplitudes) = self.batch_model(trial, contributions[index])
+            trial_cost = np.sum(trial_residuals**2, axis=1)
+
+            # Damping follows the ratio of actual to predicted decrease (Nielsen)
+            predicted = np.sum(step * (scaled * step - gradient), axis=1)
+            ratio = (cost[index] - trial_cost) / np.maximum(predicted, 1e-300)
+            better = trial_cost < cost[index]
+            small = np.sqrt(np.sum(taken**2, axis=1)) <= tolerance * (1 + np.sqrt(np.sum(positions[index]**2, axis=1)))
+            done = (better & (cost[index] - trial_cost <= tolerance * cost[index])) | small
+
+            accepted = index[better]
+            positions[accepted] = trial[better]
+            residuals[accepted] = trial_residuals[better]
+            J[accepted] = trial_J[better]
+            amplitudes[accepted] = trial_amplitudes[better]
+            cost[accepted] = trial_cost[better]
+            damping[accepted] *= np.maximum(1.0 / 3, 1 - (2 * ratio[better] - 1)**3)
+            growth[accepted] = 2.0
+            rejected = index[~better]
+            damping[rejected] *= growth[rejected]
+            growth[rejected] *= 2
+            iterations[index] += 1
+            converged[index[done]] = True
+        # One model evaluation, residuals with their Jacobian, to start and one per iteration
+        return positions, amplitudes, {'iterations': iterations, 'evaluations': iterations + 1, 'converged': converged, 'error': cost}
+
     def estimate_sources(self):
-        pca = PCA()
-        pca.fit(self.data)
-        return list(pca.explained_variance_ratio_ > 0.1).count(True)
-        #return 1
\ No newline at end of file
+        '''
+        Number of principal components explaining more than 10% of the variance
+        '''
+        return list(self.eigenvalues / self.eigenvalues.sum() > 0.1).count(True)
+
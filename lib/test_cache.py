@@ -0,0 +1,46 @@
+"""
+
+Cache files replace stale ones, also where rename does not overwrite
+
+    python -m unittest discover -s lib -t .
+
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from lib import cache
+
+class WriteCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'grid.npz')
+        self.rename = os.rename
+
+    def tearDown(self):
+        os.rename = self.rename
+        shutil.rmtree(self.directory)
+
+    def check(self):
+        cache.write_cache(self.path, lambda f: f.write(b'stale'))
+        cache.write_cache(self.path, lambda f: f.write(b'fresh'))
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), b'fresh')
+        self.assertEqual(os.listdir(self.directory), ['grid.npz'])
+
+    def test_replace(self):
+        self.check()
+
+    def test_windows_rename(self):
+        # Rename refuses an existing target like on Windows
+        def rename(source, target):
+            if os.path.exists(target):
+                raise OSError(17, 'File exists')
+            self.rename(source, target)
+        os.rename = rename
+        self.check()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+"""
+
+Sliding covariance against the covariance of the whole window
+
+    python -m unittest discover -s lib -t .
+
+"""
+
+import unittest
+import numpy as np
+from lib.covariance import SlidingCovariance
+
+class SlidingCovarianceTest(unittest.TestCase):
+
+    def setUp(self):
+        # Raw EEG sits on a large DC offset
+        random = np.random.RandomState(0)
+        self.samples = 4200.0 + np.cumsum(random.randn(4000, 14), axis=0)
+        self.size = 256
+
+    def check(self, covariance, window):
+        np.testing.assert_allclose(covariance.mean(), window.mean(axis=0), rtol=1e-12)
+        np.testing.assert_allclose(covariance.covariance(), np.cov(window, rowvar=False, bias=True),
+                                   rtol=1e-8, atol=1e-8)
+
+    def test_hops(self):
+        # More updates than recompute, with hops of varying length
+        covariance = SlidingCovariance(recompute=64)
+        end = self.size
+        covariance.update(self.samples[:end])
+        for hop in np.tile([1, 7, 32, 3], 40):
+            end += hop
+            window = self.samples[end - self.size:end]
+            covariance.update(window, hop)
+            self.check(covariance, window)
+
+    def test_new_window(self):
+        covariance = SlidingCovariance()
+        covariance.update(self.samples[:self.size])
+        window = self.samples[1000:1000 + self.size]
+        covariance.update(window)
+        self.check(covariance, window)
+        covariance.update(window, 0)
+        self.check(covariance, window)
+
+    def test_eigen(self):
+        covariance = SlidingCovariance()
+        window = self.samples[:self.size]
+        covariance.update(window)
+        (eigenvalues, eigenvectors) = covariance.eigen()
+        self.assertTrue(np.all(np.diff(eigenvalues) <= 0))
+        np.testing.assert_allclose(np.dot(eigenvectors * eigenvalues, eigenvectors.T),
+                                   np.cov(window, rowvar=False, bias=True), rtol=1e-8, atol=1e-8)
+
+if __name__ == '__main__':
+    unittest.main()
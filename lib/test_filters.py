@@ -0,0 +1,50 @@
+"""
+
+Streaming filter against one pass of sosfilt over the whole stream
+
+    python -m unittest discover -s lib -t .
+
+"""
+
+import unittest
+import numpy as np
+from scipy.signal import sosfilt, sosfilt_zi
+from lib.filters import StreamingFilter
+
+class StreamingFilterTest(unittest.TestCase):
+
+    def setUp(self):
+        # Electrode offsets, alpha, mains hum and noise
+        random = np.random.RandomState(0)
+        t = np.arange(2048) / 128.0
+        self.samples = (4300.0 + 100 * random.rand(14) + 20 * np.sin(2 * np.pi * 10 * t)[:, np.newaxis] +
+                        5 * np.sin(2 * np.pi * 50 * t)[:, np.newaxis] + random.randn(len(t), 14))
+
+    def whole(self, sos):
+        zi = sosfilt_zi(sos)[:, :, np.newaxis] * self.samples[0]
+        return sosfilt(sos, self.samples, axis=0, zi=zi)[0]
+
+    def test_process(self):
+        for (band, notch) in (((1.0, 40.0), 50.0), (None, None)):
+            stream = StreamingFilter(14, 256, band=band, notch=notch)
+            expected = self.whole(stream.sos)
+            bounds = np.cumsum([0, 1, 31, 32, 100, 0, 500])
+            chunks = [stream.process(self.samples[i:j]) for (i, j) in zip(bounds, np.append(bounds[1:], len(self.samples)))]
+            np.testing.assert_allclose(np.concatenate(chunks), expected, rtol=0, atol=1e-9)
+
+    def test_update(self):
+        stream = StreamingFilter(14, 256)
+        expected = self.whole(stream.sos)
+        for end in range(256, len(self.samples) + 1, 32):
+            window = self.samples[end - 256:end]
+            filtered = stream.update(window, 256 if end == 256 else 32)
+            np.testing.assert_allclose(filtered, expected[end - 256:end], rtol=0, atol=1e-9)
+
+    def test_reset(self):
+        stream = StreamingFilter(14, 256)
+        stream.process(self.samples[1000:1500])
+        stream.reset()
+        np.testing.assert_allclose(stream.process(self.samples), self.whole(stream.sos), rtol=0, atol=1e-9)
+
+if __name__ == '__main__':
+    unittest.main()
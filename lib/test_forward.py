@@ -0,0 +1,73 @@
+"""
+
+Spherical head lead field against the closed form of a homogeneous sphere
+
+    python -m unittest discover -s lib -t .
+
+"""
+
+import unittest
+import numpy as np
+from lib.forward import SphericalHead
+
+def homogeneous_sphere(position, electrodes, conductivity):
+    '''
+    Potential at the electrodes on a homogeneous sphere around the origin of unit dipoles along x, y and z
+    at position, Frank (1952) in the form of Mosher et al. (1999), all in m
+    '''
+    a = electrodes - position
+    d = np.sqrt(np.sum(a**2, axis=1))[:, np.newaxis]
+    R = np.sqrt(np.sum(electrodes**2, axis=1))[:, np.newaxis]
+    F = d * (R * d + R**2 - np.dot(electrodes, position)[:, np.newaxis])
+    return (2 * a / d**3 + (electrodes * d + R * a) / (R * F)) / (4 * np.pi * conductivity)
+
+class SphericalHeadTest(unittest.TestCase):
+
+    def setUp(self):
+        random = np.random.RandomState(0)
+        directions = random.randn(32, 3)
+        directions[:, 2] = np.abs(directions[:, 2])
+        directions /= np.sqrt(np.sum(directions**2, axis=1))[:, np.newaxis]
+        self.center = np.array([2.0, -5.0, 10.0])
+        self.electrodes = self.center + 95.0 * directions
+        # Sources up to 0.9 of the radius in every direction, and the center
+        offsets = random.randn(20, 3)
+        offsets *= (95.0 * 0.9 * random.rand(20) ** (1 / 3.0) / np.sqrt(np.sum(offsets**2, axis=1)))[:, np.newaxis]
+        self.positions = self.center + np.vstack((offsets, np.zeros(3)))
+        self.head = SphericalHead(self.electrodes, radii=(1.0,), conductivities=(0.33,), tolerance=1e-12, max_terms=1000)
+
+    def test_closed_form(self):
+        L = self.head.lead_field(self.positions)
+        for (position, field) in zip(self.positions, L):
+            expected = homogeneous_sphere((position - self.center) * 1e-3, (self.electrodes - self.center) * 1e-3, 0.33)
+            np.testing.assert_allclose(field, expected, rtol=0, atol=1e-9 * np.abs(expected).max())
+
+    def test_equal_shells(self):
+        # Shells of the same conductivity are one homogeneous sphere
+        shells = SphericalHead(self.electrodes, radii=(0.84, 0.8667, 0.9467, 1.0), conductivities=(0.33,) * 4)
+        np.testing.assert_allclose(shells.coefficients, 1.0, rtol=1e-12)
+
+    def test_gradient(self):
+        head = SphericalHead(self.electrodes)
+        positions = self.center + 0.8 * (self.positions - self.center)
+        (L, dL) = head.lead_field(positions, gradient=True)
+        np.testing.assert_array_equal(L, head.lead_field(positions))
+        step = 1e-4
+        for axis in range(3):
+            shift = np.zeros(3)
+            shift[axis] = step
+            difference = (head.lead_field(positions + shift) - head.lead_field(positions - shift)) / (2 * step)
+            np.testing.assert_allclose(dL[..., axis], difference, rtol=0, atol=1e-6 * np.abs(dL).max())
+
+    def test_clamp(self):
+        # Positions outside the innermost shell are evaluated on it
+        head = SphericalHead(self.electrodes)
+        outside = self.center + np.array([[0.0, 0.0, 200.0], [60.0, 60.0, 60.0]])
+        clamped = head.clamp(outside)
+        np.testing.assert_allclose(np.sqrt(np.sum((clamped - self.center)**2, axis=1)), head.limit)
+        np.testing.assert_allclose(head.lead_field(outside), head.lead_field(clamped), rtol=1e-12)
+        inside = self.positions[:5]
+        np.testing.assert_array_equal(head.clamp(inside), inside)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+"""
+
+Ring buffer reads across the wrap point and writes past the capacity
+
+    python -m unittest discover -s lib -t .
+
+"""
+
+import unittest
+import numpy as np
+from multiprocessing import Process
+from lib.ringbuffer import RingBuffer
+
+class RingBufferTest(unittest.TestCase):
+
+    def rows(self, start, count, channels=3):
+        # Row k holds k in every column, so a read shows which rows it covers
+        counters = np.arange(start, start + count, dtype=float)
+        return np.repeat(counters[:, np.newaxis], channels, axis=1), counters, counters / 128
+
+    def test_wrap(self):
+        buffer = RingBuffer(16, 3)
+        for start in range(0, 100, 5):
+            buffer.write(*self.rows(start, 5))
+            end = buffer.count()
+            buffer.release(end)
+            for size in [size for size in (1, 7, 16) if size <= end]:
+                (samples, counters, timestamps) = buffer.window(end, size)
+                expected = np.arange(end - size, end, dtype=float)
+                np.testing.assert_array_equal(counters, expected)
+                np.testing.assert_array_equal(samples, np.repeat(expected[:, np.newaxis], 3, axis=1))
+                np.testing.assert_array_equal(timestamps, expected / 128)
+        self.assertEqual(buffer.stats()['dropped'], 0)
+
+    def test_overflow(self):
+        # More than a whole buffer in one write, the count still advances by all rows
+        buffer = RingBuffer(16, 3)
+        buffer.write(*self.rows(0, 10))
+        buffer.write(*self.rows(10, 40))
+        self.assertEqual(buffer.count(), 50)
+        np.testing.assert_array_equal(buffer.window(50, 16)[1], np.arange(34, 50))
+        self.assertEqual(buffer.stats()['dropped'], 34)
+
+    def test_drop_newest(self):
+        buffer = RingBuffer(16, 3, policy='drop-newest')
+        buffer.write(*self.rows(0, 10))
+        buffer.write(*self.rows(10, 10))
+        self.assertEqual(buffer.count(), 16)
+        np.testing.assert_array_equal(buffer.window(16, 16)[1], np.arange(16))
+        self.assertEqual(buffer.stats()['dropped'], 4)
+
+    def test_process(self):
+        # Rows written by another process show up in this one
+        buffer = RingBuffer(16, 3)
+        producer = Process(target=buffer.write, args=self.rows(0, 20))
+        producer.start()
+        producer.join()
+        self.assertEqual(buffer.count(), 20)
+        np.testing.assert_array_equal(buffer.window(20, 16)[1], np.arange(4, 20))
+
+    def test_close(self):
+        # Waiting readers and blocked writers return once the buffer is closed or the timeout passes
+        buffer = RingBuffer(16, 3, policy='block')
+        self.assertEqual(buffer.wait(10, timeout=0.05), 0)
+        buffer.write(*self.rows(0, 10))
+        buffer.close()
+        self.assertEqual(buffer.wait(100), 10)
+        buffer.write(*self.rows(10, 20))
+        self.assertEqual(buffer.count(), 16)
+
+if __name__ == '__main__':
+    unittest.main()